@@ -2,6 +2,12 @@
 ASGI config for casper project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Only the ingestion progress events are served here, since they stream for as long as the
+ingestion runs and must not hold a worker thread each. Everything else is served by the
+WSGI application with gunicorn: Django 3.2 runs every sync view of an ASGI worker on a
+single thread and iterates streamed responses inside the event loop, where they can't query.
+Run it with ``uvicorn casper.asgi:application --port 8001`` and route ``/feeds/<id>/events/``
+to it.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -9,8 +15,38 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'casper.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# imported once the apps are loaded
+from orders.events import EVENTS_PATH_RE, ingestion_events, send_error  # noqa: E402
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    match = EVENTS_PATH_RE.match(scope['path'])
+    if scope['method'] != 'GET' or match is None:
+        await send_error(send, 404, 'Not found.', [])
+        return
+
+    await ingestion_events(scope, receive, send, int(match.group('feed_id')))
@@ -0,0 +1,339 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+# upper bounds in seconds of the request latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# (name, Server-Timing description) of the phases timed within a request, the rest of the time is 'app'
+PHASES = (
+    ('serialize', 'Serialization and rendering'),
+    ('pdf', 'PDF rendering'),
+)
+
+_timings = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.phases = {name: 0.0 for (name, _) in PHASES}
+        # nested blocks of the same phase are only counted once
+        self.depth = {name: 0 for (name, _) in PHASES}
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+
+        finally:
+            self.db_queries += 1
+            self.db_time += time.perf_counter() - started_at
+
+    def get_total(self):
+        return time.perf_counter() - self.started_at
+
+
+@contextmanager
+def timed(phase):
+    """
+    Adds the time spent in the block to 'phase' of the current request, when request metrics are enabled.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    timings.depth[phase] += 1
+    started_at = time.perf_counter()
+    try:
+        yield
+
+    finally:
+        timings.depth[phase] -= 1
+        if timings.depth[phase] == 0:
+            timings.phases[phase] += time.perf_counter() - started_at
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for (index, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+        self.count += 1
+        self.sum += value
+
+
+def get_empty_totals():
+    return dict(db_queries=0, db_seconds=0.0, **{f'{name}_seconds': 0.0 for (name, _) in PHASES})
+
+
+class RequestMetrics:
+    """
+    Latency histograms and query, database and phase totals per (view, method) of this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.responses = {}
+        self.totals = {}
+
+    def get_series(self, key):
+        if key not in self.latency:
+            self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.totals[key] = get_empty_totals()
+
+        return self.latency[key], self.totals[key]
+
+    def observe(self, view, method, status, timings, total):
+        key = (view, method)
+        with self.lock:
+            histogram, totals = self.get_series(key)
+            histogram.observe(total)
+            response_key = (view, method, f'{status // 100}xx')
+            self.responses[response_key] = self.responses.get(response_key, 0) + 1
+            totals['db_queries'] += timings.db_queries
+            totals['db_seconds'] += timings.db_time
+            for (name, _) in PHASES:
+                totals[f'{name}_seconds'] += timings.phases[name]
+
+    def get_snapshot(self):
+        """
+        Returns the metrics as JSON serializable lists, see merge.
+        """
+        with self.lock:
+            return {
+                'latency': [
+                    [view, method, list(histogram.counts), histogram.count, histogram.sum]
+                    for ((view, method), histogram) in self.latency.items()
+                ],
+                'responses': [[view, method, status, count] for ((view, method, status), count) in self.responses.items()],
+                'totals': [[view, method, dict(totals)] for ((view, method), totals) in self.totals.items()],
+            }
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics of a get_snapshot result, usually of another process, to these.
+        """
+        with self.lock:
+            for (view, method, counts, count, total) in snapshot['latency']:
+                histogram, _ = self.get_series((view, method))
+                histogram.counts = [a + b for (a, b) in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+
+            for (view, method, status, count) in snapshot['responses']:
+                self.responses[(view, method, status)] = self.responses.get((view, method, status), 0) + count
+
+            for (view, method, values) in snapshot['totals']:
+                _, totals = self.get_series((view, method))
+                for (name, value) in values.items():
+                    totals[name] = totals.get(name, 0) + value
+
+    def export(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = [
+                '# HELP casper_request_duration_seconds Time to produce the response of a request.',
+                '# TYPE casper_request_duration_seconds histogram',
+            ]
+            for ((view, method), histogram) in sorted(self.latency.items()):
+                labels = f'view="{view}",method="{method}"'
+                cumulative = 0
+                for (bound, count) in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'casper_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+                lines.append(f'casper_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'casper_request_duration_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'casper_request_duration_seconds_count{{{labels}}} {histogram.count}')
+
+            lines.extend([
+                '# HELP casper_requests_total Responses by status class.',
+                '# TYPE casper_requests_total counter',
+            ])
+            for ((view, method, status), count) in sorted(self.responses.items()):
+                lines.append(f'casper_requests_total{{view="{view}",method="{method}",status="{status}"}} {count}')
+
+            names = ['db_queries', 'db_seconds'] + [f'{name}_seconds' for (name, _) in PHASES]
+            for name in names:
+                lines.extend([
+                    f'# HELP casper_request_{name}_total Total {name.replace("_", " ")} of the requests.',
+                    f'# TYPE casper_request_{name}_total counter',
+                ])
+                for ((view, method), totals) in sorted(self.totals.items()):
+                    lines.append(f'casper_request_{name}_total{{view="{view}",method="{method}"}} {totals[name]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+class MetricsStore:
+    """
+    Shares the metrics of the processes of a host through METRICS_DIR, where each process writes its own
+    file, at most every METRICS_WRITE_INTERVAL seconds after a request and right before a scrape. Files of
+    exited processes stay, so the merged counters never go backwards until the directory is cleared.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.path = None
+        self.written_at = 0.0
+
+    def get_path(self):
+        # workers forked from the same master get their own file
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self.path = os.path.join(settings.METRICS_DIR, f'{pid}-{uuid.uuid4().hex}.json')
+
+        return self.path
+
+    def get_process_metrics(self):
+        # orders imports this module
+        from orders.rendering import get_renderer
+
+        return {'requests': request_metrics.get_snapshot(), 'renderer': get_renderer().get_metrics()}
+
+    def write(self, force=False):
+        if not settings.METRICS_DIR:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.written_at < settings.METRICS_WRITE_INTERVAL:
+                return
+
+            self.written_at = now
+            path = self.get_path()
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            # replaced in one step, readers never see a partial file
+            temporary_path = f'{path}.tmp'
+            with open(temporary_path, 'w') as f:
+                json.dump(self.get_process_metrics(), f)
+
+            os.replace(temporary_path, path)
+
+    def read(self):
+        """
+        Returns the metrics of every process sharing METRICS_DIR, this one included, or of this process
+        only when METRICS_DIR isn't set.
+        """
+        if not settings.METRICS_DIR:
+            return [self.get_process_metrics()]
+
+        self.write(force=True)
+        processes = []
+        for name in sorted(os.listdir(settings.METRICS_DIR)):
+            if not name.endswith('.json'):
+                continue
+
+            try:
+                with open(os.path.join(settings.METRICS_DIR, name)) as f:
+                    processes.append(json.load(f))
+
+            except (OSError, ValueError):
+                # removed since the listing
+                continue
+
+        return processes
+
+    def collect(self):
+        """
+        Returns the request metrics of every process merged in a RequestMetrics and the sums of their
+        renderer metrics.
+        """
+        metrics = RequestMetrics()
+        renderer = {}
+        for process in self.read():
+            metrics.merge(process['requests'])
+            for (name, value) in process['renderer'].items():
+                renderer[name] = renderer.get(name, 0) + value
+
+        return metrics, renderer
+
+    def clear(self):
+        if not settings.METRICS_DIR or not os.path.isdir(settings.METRICS_DIR):
+            return
+
+        for name in os.listdir(settings.METRICS_DIR):
+            try:
+                os.remove(os.path.join(settings.METRICS_DIR, name))
+
+            except FileNotFoundError:
+                pass
+
+
+metrics_store = MetricsStore()
+
+
+def get_server_timing(timings, total):
+    entries = [f'db;dur={timings.db_time * 1000:.1f};desc="{timings.db_queries} queries"']
+    accounted = timings.db_time
+    for (name, description) in PHASES:
+        if timings.phases[name]:
+            entries.append(f'{name};dur={timings.phases[name] * 1000:.1f};desc="{description}"')
+            accounted += timings.phases[name]
+
+    # queries run while serializing count in both, so 'app' is a lower bound
+    entries.append(f'app;dur={max(0.0, total - accounted) * 1000:.1f}')
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+class RequestMetricsMiddleware:
+    """
+    Times each request, its database queries and its serialization and PDF phases, adds them to the
+    response as a Server-Timing header and to the per view metrics served by /metrics. Streamed
+    content is produced after the response leaves the middleware and isn't included.
+    Disabled with REQUEST_METRICS=0, in which case the middleware is not loaded at all.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_METRICS:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings))
+
+                response = self.get_response(request)
+
+        finally:
+            _timings.reset(token)
+
+        total = timings.get_total()
+        resolver_match = getattr(request, 'resolver_match', None)
+        view = resolver_match.view_name if resolver_match is not None else 'unmatched'
+        request_metrics.observe(view, request.method, response.status_code, timings, total)
+        metrics_store.write()
+        response['Server-Timing'] = get_server_timing(timings, total)
+        return response
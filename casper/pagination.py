@@ -1,26 +1,222 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils import encoders
+from rest_framework.utils.urls import replace_query_param
 
 
 class CasperPagination(PageNumberPagination):
+    """
+    Page number pagination with two extra modes selected with the 'pagination' query param:
+    'pagination=0' returns every row and 'pagination=cursor' pages with an opaque 'cursor'
+    over (ordering fields, id), which needs neither a COUNT nor an OFFSET.
+    """
     page_size_query_param = 'limit'
     max_page_size = 500
+    cursor_query_param = 'cursor'
+    stream_chunk_size = 2000
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def is_unpaginated(self, request):
+        return request.query_params.get('pagination') == '0'
+
+    def is_keyset(self, request):
+        return request.query_params.get('pagination') == 'cursor'
 
     def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        if self.is_unpaginated(request):
+            self.rows = list(queryset)
+            return self.rows
 
-        if request.query_params.get('pagination') == '0':
-            super(CasperPagination, self).paginate_queryset(queryset, request, view)
-            return list(queryset)
+        if self.is_keyset(request):
+            return self.paginate_keyset(queryset, request)
 
         return super(CasperPagination, self).paginate_queryset(queryset, request, view)
 
+    def get_paginated_response(self, data):
+        if self.is_unpaginated(self.request):
+            return Response(OrderedDict([
+                ('count', len(self.rows)),
+                ('next', None),
+                ('previous', None),
+                ('results', data)
+            ]))
+
+        if self.is_keyset(self.request):
+            return Response(OrderedDict([
+                ('next', self.get_next_link()),
+                ('previous', None),
+                ('results', data)
+            ]))
+
+        return super(CasperPagination, self).get_paginated_response(data)
+
     def get_next_link(self):
-        if self.request.query_params.get('pagination') == '0':
+        if self.is_unpaginated(self.request):
             return None
 
+        if self.is_keyset(self.request):
+            if self.next_position is None:
+                return None
+
+            url = self.request.build_absolute_uri()
+            return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
         return super(CasperPagination, self).get_next_link()
 
     def get_previous_link(self):
-        if self.request.query_params.get('pagination') == '0':
+        if self.is_unpaginated(self.request) or self.is_keyset(self.request):
             return None
 
         return super(CasperPagination, self).get_previous_link()
+
+    def paginate_keyset(self, queryset, request):
+        page_size = self.get_page_size(request)
+        ordering = self.get_keyset_ordering(queryset)
+        position = None
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            position = self.decode_cursor(cursor, len(ordering))
+
+        rows = self.get_keyset_page(queryset, ordering, position, page_size + 1)
+        self.next_position = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = self.get_position(rows[-1], ordering)
+
+        return rows
+
+    def get_streaming_response(self, queryset, serialize):
+        """
+        Streams every row of 'queryset' as the results of a 'pagination=0' response, fetched in keyset
+        ordered chunks of 'stream_chunk_size' rows and serialized one chunk at a time with 'serialize'.
+        The count is only known at the end, so it's the last key of the object.
+        """
+        def content():
+            count = 0
+            yield b'{"next":null,"previous":null,"results":['
+            for rows in self.iter_keyset_chunks(queryset, self.stream_chunk_size):
+                data = json.dumps(serialize(rows), cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+                yield ((',' if count else '') + data[1:-1]).encode('utf-8')
+                count += len(rows)
+
+            yield f'],"count":{count}}}'.encode('utf-8')
+
+        return StreamingHttpResponse(content(), content_type='application/json')
+
+    def iter_keyset_chunks(self, queryset, chunk_size):
+        """
+        Yields lists of at most 'chunk_size' rows of 'queryset', each fetched with its own keyset query.
+        """
+        ordering = self.get_keyset_ordering(queryset)
+        position = None
+        while True:
+            rows = self.get_keyset_page(queryset, ordering, position, chunk_size)
+            if rows:
+                yield rows
+
+            if len(rows) < chunk_size:
+                break
+
+            position = self.get_position(rows[-1], ordering)
+
+    def get_keyset_ordering(self, queryset):
+        """
+        Returns the ordering of 'queryset' as (field, descending, nullable) tuples, always ending with the id.
+        """
+        ordering = []
+        for name in queryset.query.order_by or queryset.model._meta.ordering:
+            if not isinstance(name, str):
+                raise NotFound(self.invalid_cursor_message)
+
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name in ('id', 'pk'):
+                ordering.append(('id', descending, False))
+                return ordering
+
+            ordering.append((name, descending, self.is_nullable(queryset.model, name)))
+
+        ordering.append(('id', False, False))
+        return ordering
+
+    def is_nullable(self, model, name):
+        field = None
+        try:
+            for part in name.split('__'):
+                field = model._meta.get_field(part)
+                model = field.related_model
+
+        except FieldDoesNotExist:
+            return True
+
+        return field.null
+
+    def get_keyset_page(self, queryset, ordering, position, limit):
+        # NULL sorts as the smallest value, like MySQL and SQLite do with a plain ORDER BY
+        queryset = queryset.order_by(*[f'-{name}' if descending else name for (name, descending, _) in ordering])
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(ordering, position))
+
+        return list(queryset[:limit])
+
+    def get_keyset_filter(self, ordering, position):
+        condition = Q()
+        equal = Q()
+        for ((name, descending, nullable), value) in zip(ordering, position):
+            if value is None:
+                after = Q() if descending else Q(**{f'{name}__isnull': False})
+                same = Q(**{f'{name}__isnull': True})
+
+            else:
+                after = Q(**{f'{name}__{"lt" if descending else "gt"}': value})
+                if descending and nullable:
+                    after |= Q(**{f'{name}__isnull': True})
+
+                same = Q(**{name: value})
+
+            if value is not None or not descending:
+                condition |= equal & after
+
+            equal &= same
+
+        return condition
+
+    def get_position(self, row, ordering):
+        return [self.get_row_value(row, name) for (name, _, _) in ordering]
+
+    def get_row_value(self, row, name):
+        if isinstance(row, dict):
+            return row[name]
+
+        for part in name.split('__'):
+            field = row._meta.get_field(part)
+            if field.is_relation and part == name.split('__')[-1]:
+                return getattr(row, field.attname)
+
+            row = getattr(row, part)
+
+        return row
+
+    def encode_cursor(self, position):
+        data = json.dumps(position, cls=encoders.JSONEncoder, separators=(',', ':'))
+        return urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor, length):
+        try:
+            position = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+
+        except (ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(position, list) or len(position) != length:
+            raise NotFound(self.invalid_cursor_message)
+
+        return position
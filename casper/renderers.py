@@ -0,0 +1,12 @@
+from rest_framework.renderers import JSONRenderer
+from casper.metrics import timed
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer whose encoding time counts as serialization in the request metrics.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('serialize'):
+            return super(TimedJSONRenderer, self).render(data, accepted_media_type, renderer_context)
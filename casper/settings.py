@@ -13,7 +13,6 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 from datetime import timedelta
 from pathlib import Path
-import requests
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -28,23 +27,28 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'django-insecure-$1n&77hg=z&ethh#z#n0+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get('DEBUG', True)
 
-if os.environ.get('ENVIRONMENT', 'development') == 'development':
+ENVIRONMENT = os.environ.get('ENVIRONMENT', 'development')
+
+if ENVIRONMENT == 'development':
     CORS_ORIGIN_ALLOW_ALL = True
     ALLOWED_HOSTS = ['*']
 else:
-    ALLOWED_HOSTS = []
+    # comma separated, e.g. 'backend.dannyx.net,10.0.0.12'
+    ALLOWED_HOSTS = [host.strip() for host in os.environ.get('ALLOWED_HOSTS', '').split(',') if host.strip()]
+
+# Add the EC2 public IP to ALLOWED_HOSTS, opt-in since it's a blocking HTTP call on every import
+if bool(int(os.environ.get('EC2_HOST_LOOKUP', '0'))):
+    import requests
 
-# Add EC2 IP to ALLOWED_HOSTS
-EC2_PRIVATE_IP = None
-try:
-    EC2_PRIVATE_IP = requests.get(
-        'http://169.254.169.254/latest/meta-data/public-ipv4',
-        timeout=0.01).text
-except requests.exceptions.RequestException:
-    pass
+    try:
+        EC2_PUBLIC_IP = requests.get(
+            'http://169.254.169.254/latest/meta-data/public-ipv4',
+            timeout=float(os.environ.get('EC2_HOST_LOOKUP_TIMEOUT', '0.5'))).text
+    except requests.exceptions.RequestException:
+        EC2_PUBLIC_IP = None
 
-if EC2_PRIVATE_IP:
-    ALLOWED_HOSTS.append(EC2_PRIVATE_IP)
+    if EC2_PUBLIC_IP:
+        ALLOWED_HOSTS.append(EC2_PUBLIC_IP)
 
 # Application definition
 
@@ -67,6 +71,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so its timings cover the other middlewares
+    'casper.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'reversion.middleware.RevisionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -104,7 +110,8 @@ WSGI_APPLICATION = 'casper.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        # django.db.backends.sqlite3 with a file path as DATABASE_NAME runs without a MySQL server, e.g. for benchmarks
+        'ENGINE': os.environ.get('DATABASE_ENGINE', 'django.db.backends.mysql'),
         'NAME': os.environ.get('DATABASE_NAME', 'casper_db'),
         'USER': os.environ.get('DATABASE_USER', 'root'),
         'PASSWORD': os.environ.get('DATABASE_PASS', 'l3t$D01t'),
@@ -118,6 +125,9 @@ DATABASES = {
     }
 }
 
+# second connection to the same database, used to publish ingestion progress outside of the ingestion transaction
+DATABASES['progress'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -156,6 +166,12 @@ USE_TZ = False
 
 STATIC_URL = '/static/'
 
+# uploaded files get their MD5 checksum computed while they stream in
+FILE_UPLOAD_HANDLERS = [
+    'casper.uploadhandlers.ChecksumMemoryFileUploadHandler',
+    'casper.uploadhandlers.ChecksumTemporaryFileUploadHandler',
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -173,7 +189,11 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
-    'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
+    'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
+    'DEFAULT_RENDERER_CLASSES': (
+        'casper.renderers.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
 # djangorestframework-simplejwt
@@ -189,3 +209,67 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:8080",
     "http://127.0.0.1:8080",
 ]
+
+# feed ingestion
+FEED_INGEST_BATCH_SIZE = int(os.environ.get('FEED_INGEST_BATCH_SIZE', '1000'))
+# size of the in-process ingestion pool, parsing there competes for the GIL with the requests of the process,
+# so with the default 0 jobs are left for `manage.py ingest_worker`, run as its own service
+FEED_INGEST_WORKERS = int(os.environ.get('FEED_INGEST_WORKERS', '0'))
+# seconds between polls of the pool for pending and abandoned jobs
+INGEST_JOB_POLL_INTERVAL = int(os.environ.get('INGEST_JOB_POLL_INTERVAL', '10'))
+# running jobs renew their lease every INGEST_JOB_HEARTBEAT seconds and are claimed again after INGEST_JOB_LEASE without one
+INGEST_JOB_HEARTBEAT = int(os.environ.get('INGEST_JOB_HEARTBEAT', '30'))
+INGEST_JOB_LEASE = int(os.environ.get('INGEST_JOB_LEASE', '300'))
+# processes reading and parsing the rows of a feed file, files under FEED_PARSE_MIN_BYTES are parsed in the job,
+# 1 parses every file in the job until `benchmark parse --workers 1 2 4` shows a speedup on the production hosts
+FEED_PARSE_WORKERS = int(os.environ.get('FEED_PARSE_WORKERS', '1'))
+FEED_PARSE_MIN_BYTES = int(os.environ.get('FEED_PARSE_MIN_BYTES', str(2 * 1024 * 1024)))
+# rows per chunk handed from the parsing processes to the job, in order
+FEED_PARSE_CHUNK_ROWS = int(os.environ.get('FEED_PARSE_CHUNK_ROWS', '2000'))
+
+# report exports, rendered PDFs are cached on disk and evicted by age and then least recently used first
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', str(BASE_DIR / 'exports'))
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+EXPORT_CACHE_MAX_AGE = int(os.environ.get('EXPORT_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+
+# PDF rendering pool, with 0 workers PDFs are rendered in the request thread. The pool and its queue exist in
+# every gunicorn worker, so a host renders up to GUNICORN_WORKERS * PDF_RENDER_WORKERS PDFs at once and admits
+# GUNICORN_WORKERS * (PDF_RENDER_WORKERS + PDF_RENDER_MAX_QUEUE) renders, the defaults are sized per worker
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', '1'))
+# jobs of this process that may wait for a free worker before new ones are refused with a 503
+PDF_RENDER_MAX_QUEUE = int(os.environ.get('PDF_RENDER_MAX_QUEUE', '2'))
+PDF_RENDER_TIMEOUT = int(os.environ.get('PDF_RENDER_TIMEOUT', '120'))
+# pages of the orders report rendered per job, the chunks are concatenated into one PDF
+PDF_RENDER_CHUNK_PAGES = int(os.environ.get('PDF_RENDER_CHUNK_PAGES', '20'))
+
+# substring searches within a feed read the lines having the rarest trigram of the value from the trigram
+# index, unless more lines than this have it
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', '20000'))
+
+# Cache-Control of the responses for the resources of a feed, they carry an ETag of the feed version so
+# clients revalidate with a conditional GET once this expires. Use public behind a proxy that authenticates.
+FEED_CACHE_CONTROL = os.environ.get('FEED_CACHE_CONTROL', 'private, max-age=300')
+
+# seconds each process trusts its cached buyers and planners before checking their version stamp again
+DIMENSION_CACHE_CHECK_INTERVAL = int(os.environ.get('DIMENSION_CACHE_CHECK_INTERVAL', '5'))
+
+# seconds pivots stay in the default cache, keys include the feed, buyer and planner versions so they never serve
+# stale totals or labels
+PIVOT_CACHE_TIMEOUT = int(os.environ.get('PIVOT_CACHE_TIMEOUT', str(24 * 3600)))
+
+# per request timings in Server-Timing headers and per view metrics at /metrics, 0 unloads the middleware
+REQUEST_METRICS = bool(int(os.environ.get('REQUEST_METRICS', '1')))
+# /metrics requires 'Authorization: Bearer <token>' or an admin user when set or outside of development
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', None)
+# directory where the processes of a host share their metrics, merged at /metrics, empty keeps them per process
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+# seconds between writes of the metrics of a process to METRICS_DIR, they're also written before each scrape
+METRICS_WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_INTERVAL', '5'))
+
+# ingestion progress events served by the ASGI application, jobs are polled once per interval for all clients
+INGEST_EVENTS_POLL_INTERVAL = float(os.environ.get('INGEST_EVENTS_POLL_INTERVAL', '0.5'))
+# seconds between keep-alive comments on idle event streams
+INGEST_EVENTS_HEARTBEAT = int(os.environ.get('INGEST_EVENTS_HEARTBEAT', '15'))
+
+# seconds from the start of a fresh server to its first response, checked by the measure_startup command
+STARTUP_TARGET_SECONDS = float(os.environ.get('STARTUP_TARGET_SECONDS', '5'))
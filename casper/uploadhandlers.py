@@ -0,0 +1,35 @@
+import hashlib
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class ChecksumUploadMixin:
+    """
+    Computes the MD5 checksum of an uploaded file while it streams in,
+    the hex digest is set as 'checksum' on the resulting uploaded file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.md5 = hashlib.md5()
+        super(ChecksumUploadMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # the memory handler passes big files on to the next handler, which hashes them instead
+        if getattr(self, 'activated', True):
+            self.md5.update(raw_data)
+
+        return super(ChecksumUploadMixin, self).receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super(ChecksumUploadMixin, self).file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.checksum = self.md5.hexdigest()
+
+        return uploaded_file
+
+
+class ChecksumMemoryFileUploadHandler(ChecksumUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class ChecksumTemporaryFileUploadHandler(ChecksumUploadMixin, TemporaryFileUploadHandler):
+    pass
@@ -17,7 +17,7 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
-from health.views import HealthView
+from health.views import HealthView, RenderingView, MetricsView
 
 
 urlpatterns = [
@@ -27,6 +27,8 @@ urlpatterns = [
     path(r'api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path(r'api/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
     path(r'ping/', HealthView.as_view(), name='health'),
+    path(r'ping/rendering/', RenderingView.as_view(), name='health_rendering'),
+    path(r'metrics', MetricsView.as_view(), name='metrics'),
     path(r'', include('users.urls')),
     path(r'', include('orders.urls')),
 ]
@@ -3,8 +3,9 @@ set -e
 
 cd /casper
 
-python manage.py makemigrations
-
-python manage.py migrate
+# makemigrations and migrate only run when there is something to do, once per deployment
+if [ "${PREPARE_SCHEMA:-1}" = "1" ]; then
+    python manage.py prepare_schema
+fi
 
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+gunicorn configuration of the production server, read from the working directory by
+``gunicorn casper.wsgi:application``. The application is loaded and warmed up once in the
+master and the workers are forked from it, so they start with the URL resolvers, templates
+and dimension caches loaded and answer their first request without paying for them.
+Ingestion progress events are served by the ASGI application in casper/asgi.py, run apart
+with uvicorn. The workers share their metrics through METRICS_DIR, so a scrape of /metrics
+reaching any of them gets the totals of the server.
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+# read by the settings when the application is preloaded
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'casper-metrics'))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# each worker has its own PDF rendering pool and queue, see PDF_RENDER_WORKERS
+workers = int(os.environ.get('GUNICORN_WORKERS', str(min(multiprocessing.cpu_count() * 2 + 1, 8))))
+# WSGI, a slow export or a PDF waiting on the render pool only holds its own thread
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+preload_app = True
+accesslog = '-'
+
+
+def on_starting(server):
+    # the files of a previous run would be added to the counters of this one
+    from casper.metrics import metrics_store
+
+    metrics_store.clear()
+
+
+def when_ready(server):
+    # runs in the master once the application is loaded, before the first worker is forked
+    from casper.warmup import warm_up
+
+    server.log.info('Warmed up in %.2fs', warm_up())
+
+
+def post_fork(server, worker):
+    # threads don't survive the fork, each worker polls for the ingestion jobs of restarted or killed processes
+    from orders.jobs import start_job_poller
+
+    start_job_poller()
@@ -1,8 +1,64 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from casper.metrics import metrics_store
+from orders.rendering import get_renderer
 
 
 class HealthView(APIView):
     def get(self, request, format=None):
         return Response("pong", status=status.HTTP_200_OK)
+
+
+class RenderingView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, format=None):
+        return Response(get_renderer().get_metrics(), status=status.HTTP_200_OK)
+
+
+def export_renderer_metrics(metrics):
+    lines = []
+    for (name, value) in sorted(metrics.items()):
+        metric = f'casper_pdf_render_{name}' if name == 'in_flight' else f'casper_pdf_render_{name}_total'
+        lines.append(f'# TYPE {metric} {"gauge" if name == "in_flight" else "counter"}')
+        lines.append(f'{metric} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsView(APIView):
+    """
+    Request and PDF rendering metrics in the Prometheus text format, of every process sharing METRICS_DIR
+    or of this process only without it. Outside of development, or when METRICS_TOKEN is set, only admin
+    users and scrapers sending the token as a bearer token get them.
+    """
+    permission_classes = ()
+
+    def has_token(self, request):
+        if not settings.METRICS_TOKEN:
+            return False
+
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        return constant_time_compare(authorization, f'Bearer {settings.METRICS_TOKEN}')
+
+    def perform_authentication(self, request):
+        # the JWT authentication would reject the token of scrapers
+        if not self.has_token(request):
+            super(MetricsView, self).perform_authentication(request)
+
+    def get(self, request, format=None):
+        if not self.has_token(request) and (settings.METRICS_TOKEN or settings.ENVIRONMENT != 'development'):
+            if not request.user.is_authenticated:
+                return HttpResponse('Unauthorized', status=status.HTTP_401_UNAUTHORIZED, content_type='text/plain')
+
+            if not request.user.is_admin:
+                return HttpResponse('Forbidden', status=status.HTTP_403_FORBIDDEN, content_type='text/plain')
+
+        metrics, renderer_metrics = metrics_store.collect()
+        content = metrics.export() + export_renderer_metrics(renderer_metrics)
+        return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,11 +1,11 @@
 from django.contrib import admin
-from orders.models import Feed, Line, Buyer, Planner, Summary
+from orders.models import Feed, Line, Buyer, Planner, Summary, IngestionJob
 # Register your models here.
 
 
 @admin.register(Feed)
 class FeedAdmin(admin.ModelAdmin):
-    list_display = ('id', 'filename', 'uploaded_by', 'created_at',)
+    list_display = ('id', 'filename', 'uploaded_by', 'ingested', 'created_at',)
     raw_id_fields = ('uploaded_by',)
 
 
@@ -35,3 +35,10 @@ class SummaryAdmin(admin.ModelAdmin):
     list_display = ('id', 'feed', 'buyer', 'start_date', 'quantity', 'extended_quantity',)
     search_fields = ('buyer__code', 'buyer__name',)
     raw_id_fields = ('feed', 'buyer',)
+
+
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'feed', 'state', 'rows_processed', 'rows_skipped', 'started_at', 'finished_at',)
+    list_filter = ('state',)
+    raw_id_fields = ('feed',)
@@ -0,0 +1,299 @@
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from tempfile import NamedTemporaryFile
+from openpyxl import Workbook
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework.test import APIClient
+from orders.exports import get_filter_params, get_orders_export_name, remove_export
+from orders.ingestion import ingest_lines, ingest_rows
+from orders.models import Feed, Line, Buyer, Planner
+from orders.parsing import FEED_SITE, read_feed_lines
+from orders.search import filter_substring
+from orders.serializers import LineShortSerializer, LineRowSerializer
+from users.models import User
+
+BUYER_CODES = ('ORT', 'ABC', 'DEF', 'GHI', 'JKL')
+PLANNER_CODES = ('P01', 'P02', 'P03', 'P04')
+# the 25 columns of the ERP export, the generated rows follow this layout
+FEED_HEADER = (
+    'Sales order', 'Line', 'Item number', 'Item description', 'Revision', 'Quantity', 'Unit',
+    'Requested receipt date', 'Requested ship date', 'Confirmed ship date', 'Note', 'Site', 'Ship to name',
+    'Ship to address', 'Currency', 'Unit price', 'Net amount', 'Customer reference', 'Buyer', 'Planner',
+    'Sales taker', 'Customer PO', 'Original commit date', 'Created', 'Modified',
+)
+KIT_ITEMS = ('EZC6A24Q12-01', 'EZC5E48Q24-02', 'EZRD6100Q100-01', 'EZC624Q6-03')
+SEARCH_TERMS = (
+    ('item_number', 'ss-1234'),
+    ('item_number', '4Q12'),
+    ('item_number', '777'),
+    ('note', 'material'),
+    ('note', 'ship'),
+    ('customer_reference', 'REF-12'),
+    ('customer_reference', '999'),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """
+    Runs the block in a transaction that is always rolled back.
+    """
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback()
+
+    except Rollback:
+        pass
+
+
+def ensure_dimensions():
+    for code in BUYER_CODES:
+        Buyer.objects.get_or_create(code=code, defaults={'name': code})
+
+    # rows without a planner fall back to the planner named after the buyer
+    for code in PLANNER_CODES + BUYER_CODES:
+        Planner.objects.get_or_create(code=code, defaults={'name': code})
+
+
+def generate_rows(count, seed=0, skip_ratio=0.05):
+    """
+    Yields 'count' synthetic feed rows following the 25 column layout of the ERP export.
+    """
+    rnd = random.Random(seed)
+    base = datetime(2021, 7, 5)
+    for index in range(count):
+        buyer_code = rnd.choice(BUYER_CODES)
+        if buyer_code == 'ORT' and rnd.random() < 0.5:
+            item_number = rnd.choice(KIT_ITEMS)
+
+        else:
+            item_number = f'SS-{rnd.randint(10000, 99999)}-{rnd.randint(1, 9)}'
+
+        quantity = rnd.randint(1, 5000)
+        unit_price = rnd.randint(1, 99999) / 100
+        confirmed_shipping = base + timedelta(days=rnd.randint(0, 180))
+        site = FEED_SITE if rnd.random() >= skip_ratio else '105-MX'
+        yield (
+            f'{1000000 + index // 3}',
+            None,
+            item_number,
+            None,
+            rnd.choice(('A', 'B', 'C')),
+            float(quantity),
+            'pcs',
+            confirmed_shipping + timedelta(days=7),
+            confirmed_shipping - timedelta(days=3),
+            confirmed_shipping,
+            rnd.choice((None, 'Expedite', 'Waiting for material', 'Partial shipment')),
+            site,
+            f'Customer {rnd.randint(1, 40)}',
+            None,
+            None,
+            unit_price,
+            round(unit_price * quantity, 2),
+            f'REF-{rnd.randint(1, 9999)}',
+            buyer_code,
+            rnd.choice(PLANNER_CODES + (None,)),
+            'jdoe',
+            f'PO-{rnd.randint(100000, 999999)}',
+            confirmed_shipping - timedelta(days=14),
+            base,
+            base,
+        )
+
+
+def write_feed_xlsx(rows, dst):
+    """
+    Writes the header of the ERP export and 'rows' to the first worksheet of an XLSX workbook saved to 'dst',
+    a path or a file object. The workbook is write-only, so rows are streamed to the file.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(FEED_HEADER)
+    for row in rows:
+        ws.append(row)
+
+    wb.save(dst)
+
+
+def create_feed(rows, batch_size=None):
+    ensure_dimensions()
+    feed = Feed.objects.create(file='feeds/benchmark.xlsx', filename='benchmark.xlsx')
+    stats = ingest_rows(feed, rows, batch_size=batch_size)
+    return feed, stats
+
+
+def benchmark_ingestion(rows, batch_size):
+    """
+    Ingests 'rows' into a throwaway feed and returns the elapsed time and stats.
+    Everything written is rolled back.
+    """
+    with rolled_back():
+        start = time.perf_counter()
+        _, stats = create_feed(rows, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+
+    return elapsed, stats
+
+
+def benchmark_parsing(rows, workers):
+    """
+    Writes 'rows' to an XLSX feed and reads and parses it with read_feed_lines once for each process
+    count of 'workers', 1 being the single process run. Yields (workers, elapsed, parsed rows,
+    same results as the first run).
+    """
+    with NamedTemporaryFile(suffix='.xlsx') as dst:
+        write_feed_xlsx(rows, dst)
+        dst.flush()
+        expected = None
+        for count in workers:
+            parsed_rows, elapsed, _ = measure(lambda: list(read_feed_lines(dst.name, workers=count)))
+            if expected is None:
+                expected = parsed_rows
+
+            yield count, elapsed, len(parsed_rows), parsed_rows == expected
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(func):
+    """
+    Returns the result of calling 'func', the elapsed time and the number of queries it ran.
+    """
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+
+    return result, elapsed, queries.count
+
+
+def get_peak_rss():
+    # the high-water mark of the resident set of this process in bytes, ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_response(client, url):
+    response = client.get(url)
+    # streamed and file responses are only produced as they're read, the test client closes them at the end
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    if response.status_code != 200:
+        raise RuntimeError(f'GET {url} returned {response.status_code}: {content[:200]!r}')
+
+    return content
+
+
+def benchmark_feed(rows, sizes, repeat=3, exports=True):
+    """
+    Uploads 'rows' as an XLSX feed through the upload endpoint and ingests it the way the ingestion jobs do,
+    then requests the orders list for each page size of 'sizes' with page numbers and cursors and streamed
+    unpaginated, keeping the median of 'repeat' requests, and the summary and orders PDF exports.
+    Yields a dict per measurement. Database changes are rolled back and the stored files are removed.
+    """
+    files = []
+    try:
+        with rolled_back():
+            ensure_dimensions()
+            user = User.objects.create(email='benchmark@casper.local', first_name='Bench', last_name='Mark', is_admin=True)
+            client = APIClient()
+            client.force_authenticate(user)
+            with NamedTemporaryFile(suffix='.xlsx') as src:
+                write_feed_xlsx(rows, src)
+                size = src.tell()
+                src.seek(0)
+                response, elapsed, queries = measure(lambda: client.post('/feeds/upload/', {'file': src}, format='multipart'))
+
+            if response.status_code != 202:
+                raise RuntimeError(f'The upload returned {response.status_code}: {response.data}')
+
+            feed = Feed.objects.get(id=response.data['feed'])
+            files.append(feed.file.name)
+            yield {'stage': 'upload', 'bytes': size, 'elapsed': elapsed, 'queries': queries}
+
+            stats, elapsed, queries = measure(lambda: ingest_lines(feed, read_feed_lines(feed.file.name)))
+            Feed.objects.filter(id=feed.id).update(ingested=True)
+            yield {
+                'stage': 'ingest',
+                'rows': stats['rows_processed'],
+                'lines': stats['lines'],
+                'elapsed': elapsed,
+                'rows_per_second': stats['rows_processed'] / elapsed,
+                'queries': queries,
+            }
+
+            urls = [(mode, size, f'/feeds/{feed.id}/orders/?{query}limit={size}')
+                    for size in sizes for (mode, query) in (('page', ''), ('cursor', 'pagination=cursor&'))]
+            urls.append(('stream', stats['lines'], f'/feeds/{feed.id}/orders/?pagination=0'))
+            for (mode, size, url) in urls:
+                timings = []
+                for _ in range(repeat):
+                    _, elapsed, queries = measure(lambda: get_response(client, url))
+                    timings.append(elapsed)
+
+                yield {'stage': 'orders_list', 'mode': mode, 'page_size': size, 'elapsed': statistics.median(timings),
+                       'queries': queries}
+
+            if not exports:
+                return
+
+            for (stage, url) in (('summary_export', f'/feeds/{feed.id}/summary/export/'),
+                                 ('orders_export', f'/feeds/{feed.id}/orders/export/')):
+                content, elapsed, queries = measure(lambda: get_response(client, url))
+                yield {'stage': stage, 'bytes': len(content), 'elapsed': elapsed, 'queries': queries}
+
+            files.append(Feed.objects.filter(id=feed.id).values_list('summary_file', flat=True).first())
+            remove_export(os.path.join(settings.EXPORT_CACHE_DIR, get_orders_export_name(feed, get_filter_params({}))))
+
+    finally:
+        for name in files:
+            if name:
+                Feed.file.field.storage.delete(name)
+
+
+def benchmark_order_serialization(feed, sizes):
+    """
+    Serializes the first lines of 'feed' with the nested serializer used before and with the
+    values() based row serializer, for each of 'sizes'. Yields (size, path, elapsed, queries).
+    """
+    row_serializer = LineRowSerializer()
+    queryset = feed.lines.order_by('id')
+    for size in sizes:
+        _, elapsed, queries = measure(lambda: LineShortSerializer(list(queryset[:size]), many=True).data)
+        yield size, 'nested serializer', elapsed, queries
+        _, elapsed, queries = measure(lambda: row_serializer.serialize(row_serializer.get_values(queryset)[:size]))
+        yield size, 'row serializer', elapsed, queries
+
+
+def benchmark_search(feed, terms):
+    """
+    Runs each (field, term) of 'terms' against the lines of 'feed' with a plain icontains and through
+    the trigram index. Yields (field, term, matches, icontains elapsed, trigram elapsed, same result).
+    """
+    queryset = Line.objects.filter(feed=feed).order_by('id')
+    for (name, term) in terms:
+        plain, plain_elapsed, _ = measure(lambda: list(
+            queryset.filter(**{f'{name}__icontains': term}).values_list('id', flat=True)))
+        indexed, indexed_elapsed, _ = measure(lambda: list(
+            filter_substring(queryset, name, term, feed_id=feed.id).values_list('id', flat=True)))
+        yield name, term, len(plain), plain_elapsed, indexed_elapsed, plain == indexed
@@ -0,0 +1,63 @@
+import hashlib
+from functools import wraps
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, urlencode
+from orders import dimensions
+from orders.models import Feed
+
+
+def get_feed_etag(feed_id, version, request):
+    """
+    Returns the ETag of the response to 'request' for a resource of a feed, made of the feed id, its version,
+    the versions of the buyers and planners and the path with the sorted query string.
+    """
+    params = urlencode(sorted((key, value) for (key, values) in request.query_params.lists() for value in values))
+    key = f'{feed_id}:{version}:{dimensions.get_versions()}:{request.path}?{params}'
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return f'"{digest}"'
+
+
+def set_cache_headers(response, etag, updated_at):
+    response['ETag'] = etag
+    if updated_at is not None:
+        response['Last-Modified'] = http_date(updated_at.timestamp())
+
+    response['Cache-Control'] = settings.FEED_CACHE_CONTROL
+    patch_vary_headers(response, ('Authorization', 'Cookie'))
+
+
+def conditional_feed(feed_kwarg):
+    """
+    Decorates a view action serving a resource of the feed whose id is the url kwarg 'feed_kwarg'. Conditional
+    GETs matching the current version of the feed and of the buyers and planners get a 304 before the action
+    runs, other successful responses get the ETag, Last-Modified and Cache-Control headers.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            try:
+                feed_id = int(kwargs.get(feed_kwarg))
+
+            except (TypeError, ValueError):
+                return method(self, request, *args, **kwargs)
+
+            state = Feed.objects.filter(id=feed_id).values_list('version', 'updated_at').first()
+            if state is None:
+                return method(self, request, *args, **kwargs)
+
+            version, updated_at = state
+            etag = get_feed_etag(feed_id, version, request)
+            # only the ETag is validated, edits of buyers and planners don't change the feed's updated_at
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = method(self, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+
+            set_cache_headers(response, etag, updated_at)
+            return response
+
+        return wrapper
+
+    return decorator
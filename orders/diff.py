@@ -0,0 +1,84 @@
+from orders.ingestion import ensure_line_hashes
+from orders.models import Line
+
+DIFF_FIELDS = ('confirmed_shipping', 'quantity', 'note',)
+DIFF_CHUNK_SIZE = 1000
+
+
+def get_lines_by_key(feed):
+    """
+    Returns the (id, content_hash) pairs of the lines of 'feed' grouped by key hash, in id order.
+    """
+    lines_by_key = {}
+    queryset = feed.lines.order_by('id').values_list('key_hash', 'id', 'content_hash')
+    for (key_hash, line_id, content_hash) in queryset.iterator(chunk_size=DIFF_CHUNK_SIZE):
+        lines_by_key.setdefault(key_hash, []).append((line_id, content_hash))
+
+    return lines_by_key
+
+
+def get_lines(queryset, ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), DIFF_CHUNK_SIZE):
+        yield from queryset.filter(id__in=ids[start:start + DIFF_CHUNK_SIZE])
+
+
+def diff_feeds(feed, other):
+    """
+    Compares the lines of 'feed' with the lines of 'other', the feed taken as reference.
+    Lines are matched on sales order + item + purchase order through their key hashes, lines sharing
+    a key are paired in the order they were ingested. Returns the ids of the added and removed lines
+    and the (other line id, line id) pairs whose confirmed shipping date, quantity or note changed.
+    """
+    ensure_line_hashes(feed)
+    ensure_line_hashes(other)
+    current = get_lines_by_key(feed)
+    previous = get_lines_by_key(other)
+    added, removed, changed = [], [], []
+    unchanged = 0
+    for (key_hash, lines) in current.items():
+        previous_lines = previous.get(key_hash, ())
+        for (index, (line_id, content_hash)) in enumerate(lines):
+            if index >= len(previous_lines):
+                added.append(line_id)
+
+            elif previous_lines[index][1] != content_hash:
+                changed.append((previous_lines[index][0], line_id))
+
+            else:
+                unchanged += 1
+
+        removed.extend(line_id for (line_id, _) in previous_lines[len(lines):])
+
+    for (key_hash, previous_lines) in previous.items():
+        if key_hash not in current:
+            removed.extend(line_id for (line_id, _) in previous_lines)
+
+    return {
+        'added': added,
+        'removed': removed,
+        'changed': changed,
+        'unchanged': unchanged,
+    }
+
+
+def get_field_changes(changed):
+    """
+    Yields the field level changes of the (other line id, line id) pairs in 'changed'.
+    """
+    fields = ('id', 'sales_order_number', 'item_number', 'purchase_order_number',) + DIFF_FIELDS
+    ids = [line_id for pair in changed for line_id in pair]
+    values = {line['id']: line for line in get_lines(Line.objects.values(*fields), ids)}
+    for (previous_id, line_id) in changed:
+        before, after = values[previous_id], values[line_id]
+        yield {
+            'id': line_id,
+            'previous_id': previous_id,
+            'sales_order_number': after['sales_order_number'],
+            'item_number': after['item_number'],
+            'purchase_order_number': after['purchase_order_number'],
+            'changes': {
+                field: {'from': before[field], 'to': after[field]}
+                for field in DIFF_FIELDS if before[field] != after[field]
+            },
+        }
@@ -0,0 +1,132 @@
+import threading
+import time
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.utils.module_loading import import_string
+from orders.models import Buyer, DimensionVersion, Planner
+
+
+class DimensionCache:
+    """
+    Process-local copy of a small dimension table, by code and by id, with the serialized representation
+    of each row. Saves and deletes in this process drop it right away, other processes see the version
+    stamp change within DIMENSION_CACHE_CHECK_INTERVAL seconds. The cached objects and dicts are shared
+    between threads and must not be modified.
+    """
+
+    def __init__(self, model, serializer_path):
+        self.model = model
+        self.name = model._meta.db_table
+        self.serializer_path = serializer_path
+        self.lock = threading.Lock()
+        # (version, objects by code, objects by id, serialized rows by id)
+        self.state = None
+        self.checked_at = 0.0
+
+    def get_version(self):
+        return DimensionVersion.objects.filter(name=self.name).values_list('version', flat=True).first() or 0
+
+    def load(self, version):
+        serializer_class = import_string(self.serializer_path)
+        objects = list(self.model.objects.all())
+        return (
+            version,
+            {instance.code: instance for instance in objects},
+            {instance.id: instance for instance in objects},
+            {instance.id: dict(serializer_class(instance).data) for instance in objects},
+        )
+
+    def get_state(self, refresh=False):
+        now = time.monotonic()
+        state = self.state
+        if state is not None and not refresh and now - self.checked_at < settings.DIMENSION_CACHE_CHECK_INTERVAL:
+            return state
+
+        version = self.get_version()
+        if refresh or state is None or state[0] != version:
+            state = self.load(version)
+
+        with self.lock:
+            self.state = state
+            self.checked_at = now
+
+        return state
+
+    def invalidate(self):
+        with self.lock:
+            self.state = None
+
+    def get_by_code(self, code):
+        """
+        Returns the row with 'code', reloading the table once if it's unknown since another process
+        may have just added it. Raises KeyError if there's still no such row.
+        """
+        try:
+            return self.get_state()[1][code]
+
+        except KeyError:
+            return self.get_state(refresh=True)[1][code]
+
+    def get_by_id(self, pk):
+        try:
+            return self.get_state()[2][pk]
+
+        except KeyError:
+            return self.get_state(refresh=True)[2][pk]
+
+    def get_data(self, pk):
+        """
+        Returns the serialized row with id 'pk', or None for a row that doesn't exist.
+        """
+        data = self.get_state()[3].get(pk)
+        if data is None and pk is not None:
+            data = self.get_state(refresh=True)[3].get(pk)
+
+        return data
+
+
+buyers = DimensionCache(Buyer, 'orders.serializers.BuyerSerializer')
+planners = DimensionCache(Planner, 'orders.serializers.PlannerSerializer')
+CACHES = {cache.model: cache for cache in (buyers, planners)}
+
+
+def get_versions():
+    """
+    Returns the versions of the buyers and planners cached in this process, for the keys of data embedding them.
+    """
+    return ':'.join(str(cache.get_state()[0]) for cache in (buyers, planners))
+
+
+def get_code(cache, pk):
+    # rows deleted since the lines were grouped keep a label
+    data = cache.get_data(pk)
+    return data['code'] if data is not None else f'#{pk}'
+
+
+def bump_dimension_version(name):
+    if DimensionVersion.objects.filter(name=name).update(version=F('version') + 1):
+        return
+
+    try:
+        with transaction.atomic():
+            DimensionVersion.objects.create(name=name, version=1)
+
+    except IntegrityError:
+        # created concurrently
+        DimensionVersion.objects.filter(name=name).update(version=F('version') + 1)
+
+
+def dimension_changed(sender, **kwargs):
+    cache = CACHES[sender]
+    bump_dimension_version(cache.name)
+    # dropped now for the rest of the transaction, and again once the change is visible to other threads
+    cache.invalidate()
+    transaction.on_commit(cache.invalidate)
+
+
+def connect_signals():
+    for model in CACHES:
+        post_save.connect(dimension_changed, sender=model, dispatch_uid=f'dimension_saved_{model.__name__}')
+        post_delete.connect(dimension_changed, sender=model, dispatch_uid=f'dimension_deleted_{model.__name__}')
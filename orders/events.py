@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from orders.models import IngestionJob
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH_RE = re.compile(r'^/feeds/(?P<feed_id>\d+)/events/?$')
+JOB_FIELDS = ('state', 'rows_processed', 'rows_skipped', 'lines_inserted', 'summaries_written', 'error',
+              'started_at', 'finished_at')
+FINISHED_STATES = (IngestionJob.DONE, IngestionJob.FAILED)
+
+
+def get_job_states(feed_ids):
+    try:
+        jobs = IngestionJob.objects.filter(feed_id__in=feed_ids).values('feed_id', *JOB_FIELDS)
+        return {job.pop('feed_id'): job for job in jobs}
+
+    except DatabaseError:
+        # the poller's connection is long lived, a new one is opened on the next poll
+        connection.close()
+        raise
+
+
+def get_access_error(raw_token, feed_id):
+    """
+    Returns the status and message of the error response when 'raw_token' isn't a valid access token of
+    an active user or 'feed_id' has no ingestion job, None if the events can be streamed.
+    """
+    authentication = JWTAuthentication()
+    try:
+        if raw_token is None:
+            return 401, 'Authentication credentials were not provided.'
+
+        try:
+            authentication.get_user(authentication.get_validated_token(raw_token))
+
+        except (InvalidToken, AuthenticationFailed):
+            return 401, 'Invalid or expired token.'
+
+        if not IngestionJob.objects.filter(feed_id=feed_id).exists():
+            return 404, 'Not found.'
+
+        return None
+
+    finally:
+        connection.close()
+
+
+class Watcher:
+    def __init__(self):
+        self.state = None
+        self.changed = asyncio.Event()
+
+    def notify(self, state):
+        if state != self.state:
+            self.state = state
+            self.changed.set()
+
+
+class ProgressBroadcaster:
+    """
+    Polls the ingestion jobs of every watched feed with a single query each INGEST_EVENTS_POLL_INTERVAL
+    seconds and hands the latest state to the watchers, so the cost doesn't grow with the clients.
+    The poller only runs while someone is watching.
+    """
+
+    def __init__(self):
+        self.watchers = {}
+        self.task = None
+
+    def subscribe(self, feed_id):
+        watcher = Watcher()
+        self.watchers.setdefault(feed_id, set()).add(watcher)
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+        return watcher
+
+    def unsubscribe(self, feed_id, watcher):
+        watchers = self.watchers.get(feed_id, set())
+        watchers.discard(watcher)
+        if not watchers:
+            self.watchers.pop(feed_id, None)
+
+    async def run(self):
+        try:
+            while self.watchers:
+                try:
+                    states = await sync_to_async(get_job_states)(list(self.watchers))
+
+                except DatabaseError:
+                    logger.exception('Could not poll the ingestion jobs')
+                    states = {}
+
+                for (feed_id, state) in states.items():
+                    for watcher in list(self.watchers.get(feed_id, ())):
+                        watcher.notify(state)
+
+                await asyncio.sleep(settings.INGEST_EVENTS_POLL_INTERVAL)
+
+        finally:
+            self.task = None
+
+
+broadcaster = ProgressBroadcaster()
+
+
+def get_event(state):
+    name = 'progress' if state['state'] not in FINISHED_STATES else state['state']
+    return f'event: {name}\ndata: {json.dumps(state, cls=DjangoJSONEncoder)}\n\n'.encode('utf-8')
+
+
+def get_cors_headers(headers):
+    origin = headers.get(b'origin', b'').decode('latin-1')
+    if origin and (getattr(settings, 'CORS_ORIGIN_ALLOW_ALL', False) or origin in settings.CORS_ALLOWED_ORIGINS):
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+
+    return []
+
+
+async def send_error(send, status, message, headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')] + headers})
+    await send({'type': 'http.response.body', 'body': json.dumps({'error': message}).encode('utf-8')})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def ingestion_events(scope, receive, send, feed_id):
+    """
+    Streams the ingestion progress of the feed 'feed_id' as server-sent events: 'progress' while the job
+    is pending or running, then a final 'done' or 'failed' event with its error. The access token is
+    read from the Authorization header or, since EventSource can't set headers, the 'token' query param.
+    """
+    headers = dict(scope['headers'])
+    cors_headers = get_cors_headers(headers)
+    authorization = headers.get(b'authorization', b'').decode('latin-1').split()
+    tokens = parse_qs(scope['query_string'].decode('latin-1')).get('token', [])
+    raw_token = authorization[1] if len(authorization) == 2 and authorization[0] == 'Bearer' else next(iter(tokens), None)
+    error = await sync_to_async(get_access_error, thread_sensitive=False)(raw_token, feed_id)
+    if error is not None:
+        await send_error(send, *error, cors_headers)
+        return
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream'),
+        (b'cache-control', b'no-cache'),
+        # proxies must pass the events through as they're written
+        (b'x-accel-buffering', b'no'),
+    ] + cors_headers})
+    await send({'type': 'http.response.body', 'body': b'retry: 2000\n\n', 'more_body': True})
+    watcher = broadcaster.subscribe(feed_id)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while True:
+            changed = asyncio.ensure_future(watcher.changed.wait())
+            await asyncio.wait({disconnect, changed}, timeout=settings.INGEST_EVENTS_HEARTBEAT,
+                               return_when=asyncio.FIRST_COMPLETED)
+            changed.cancel()
+            if disconnect.done():
+                return
+
+            if not watcher.changed.is_set():
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                continue
+
+            watcher.changed.clear()
+            state = watcher.state
+            await send({'type': 'http.response.body', 'body': get_event(state), 'more_body': True})
+            if state['state'] in FINISHED_STATES:
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+
+    finally:
+        disconnect.cancel()
+        broadcaster.unsubscribe(feed_id, watcher)
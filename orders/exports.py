@@ -0,0 +1,170 @@
+import csv
+import hashlib
+import os
+import tempfile
+import time
+from django.conf import settings
+from django.http.request import QueryDict
+from django.utils.http import urlencode
+from django_filters.filters import BaseInFilter
+from openpyxl import Workbook
+from orders.filters import LineFilter
+
+# (title, values() column), the columns of the orders report with the full note
+EXPORT_COLUMNS = (
+    ('SO#', 'sales_order_number'),
+    ('P/N', 'item_number'),
+    ('Rev.', 'revision'),
+    ('Qty', 'quantity'),
+    ('Ext. Qty', 'extended_quantity'),
+    ('UM', 'unit'),
+    ('Ship Date', 'confirmed_shipping'),
+    ('PO#', 'purchase_order_number'),
+    ('Buyer', 'buyer__code'),
+    ('Planner', 'planner__code'),
+    ('Note', 'note'),
+)
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class Echo:
+    """
+    File-like object that returns what is written to it, so csv.writer output can be yielded.
+    """
+
+    def write(self, value):
+        return value
+
+
+def get_export_values(queryset):
+    # the ordering fields of the orders endpoint are all export columns, the id breaks ties between chunks
+    return queryset.values('id', *[column for (_, column) in EXPORT_COLUMNS])
+
+
+def get_export_row(row):
+    return [row[column] for (_, column) in EXPORT_COLUMNS]
+
+
+def iter_csv_export(chunks):
+    """
+    Yields the CSV export of the line rows in 'chunks', one string per chunk after the header.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([title for (title, _) in EXPORT_COLUMNS])
+    for rows in chunks:
+        yield ''.join(writer.writerow(get_export_row(row)) for row in rows)
+
+
+def write_xlsx_export(chunks, dst):
+    """
+    Writes the XLSX export of the line rows in 'chunks' to the file object 'dst'. The write only
+    worksheet spools rows to a temporary file as they are appended, so memory use doesn't grow with them.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Orders')
+    ws.append([title for (title, _) in EXPORT_COLUMNS])
+    for rows in chunks:
+        for row in rows:
+            ws.append(get_export_row(row))
+
+    wb.save(dst)
+
+
+def get_filter_params(query_params):
+    """
+    Returns the LineFilter parameters of 'query_params' as a QueryDict with sorted keys, stripped values and
+    the items of list filters sorted, so requests selecting the same lines get the same parameters.
+    """
+    params = []
+    for (name, line_filter) in sorted(LineFilter.base_filters.items()):
+        value = (query_params.get(name) or '').strip()
+        if isinstance(line_filter, BaseInFilter):
+            value = ','.join(sorted(set(item.strip() for item in value.split(',') if item.strip())))
+
+        if value:
+            params.append((name, value))
+
+    return QueryDict(urlencode(params))
+
+
+def get_orders_export_name(feed, params):
+    digest = hashlib.sha256(params.urlencode().encode('utf-8')).hexdigest()
+    return f'orders-{feed.id}-{digest[:32]}.pdf'
+
+
+def get_cached_export(name, write):
+    """
+    Returns the cached export 'name' opened for reading, it's written by calling 'write' with a file object
+    when it's missing or older than EXPORT_CACHE_MAX_AGE. Access times record the last use for eviction.
+    """
+    path = os.path.join(settings.EXPORT_CACHE_DIR, name)
+    try:
+        stat = os.stat(path)
+        if time.time() - stat.st_mtime < settings.EXPORT_CACHE_MAX_AGE:
+            src = open(path, 'rb')
+            os.utime(path, (time.time(), stat.st_mtime))
+            return src
+
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(settings.EXPORT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.EXPORT_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            write(dst)
+
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    evict_exports(reserve=os.path.getsize(tmp_path))
+    # the rename is atomic, readers never see a partially written export
+    os.replace(tmp_path, path)
+    return open(path, 'rb')
+
+
+def evict_exports(reserve=0):
+    """
+    Deletes the cached exports older than EXPORT_CACHE_MAX_AGE, then the least recently used ones
+    until the cache and 'reserve' more bytes fit in EXPORT_CACHE_MAX_BYTES.
+    """
+    now = time.time()
+    entries = []
+    with os.scandir(settings.EXPORT_CACHE_DIR) as scan:
+        for entry in scan:
+            if entry.name.endswith('.tmp') or not entry.is_file():
+                continue
+
+            try:
+                stat = entry.stat()
+
+            except FileNotFoundError:
+                continue
+
+            if now - stat.st_mtime >= settings.EXPORT_CACHE_MAX_AGE:
+                remove_export(entry.path)
+
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    total = sum(size for (_, size, _) in entries) + reserve
+    for (_, size, path) in sorted(entries):
+        if total <= settings.EXPORT_CACHE_MAX_BYTES:
+            break
+
+        remove_export(path)
+        total -= size
+
+
+def remove_export(path):
+    # open files stay readable after the unlink, a response being served isn't affected
+    try:
+        os.remove(path)
+
+    except FileNotFoundError:
+        pass
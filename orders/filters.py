@@ -13,10 +13,11 @@ class LineFilter(FilterSet):
     id = IntegerListFilter(field_name='id', lookup_expr='in')
     sales_order_number = ListFilter(field_name='sales_order_number', lookup_expr='in')
     purchase_order_number = ListFilter(field_name='purchase_order_number', lookup_expr='in')
-    item_number = CharFilter(field_name='item_number', lookup_expr='icontains')
+    item_number = CharFilter(field_name='item_number', lookup_expr='icontains', method='filter_substring')
     buyer = ListFilter(field_name='buyer__code', lookup_expr='in')
     planner = ListFilter(field_name='planner__code', lookup_expr='in')
-    note = CharFilter(field_name='note', lookup_expr='icontains')
+    note = CharFilter(field_name='note', lookup_expr='icontains', method='filter_substring')
+    customer_reference = CharFilter(field_name='customer_reference', lookup_expr='icontains', method='filter_substring')
     confirmed_shipping_lt = NumberFilter(field_name='confirmed_shipping', lookup_expr='lt', method='filter_datetime_lt')
     confirmed_shipping_lte = NumberFilter(field_name='confirmed_shipping', lookup_expr='lte', method='filter_datetime_lte')
     confirmed_shipping_gt = NumberFilter(field_name='confirmed_shipping', lookup_expr='gt', method='filter_datetime_gt')
@@ -25,6 +26,19 @@ class LineFilter(FilterSet):
     class Meta:
         order_by_field = 'order_by'
 
+    def __init__(self, data=None, queryset=None, *, request=None, prefix=None, feed=None):
+        super(LineFilter, self).__init__(data=data, queryset=queryset, request=request, prefix=prefix)
+        # substring searches within a feed go through its trigram index
+        self.feed_id = feed.id if feed is not None else None
+        parser_context = getattr(request, 'parser_context', None) or {}
+        if self.feed_id is None and parser_context.get('kwargs', {}).get('feed_pk') is not None:
+            self.feed_id = int(parser_context['kwargs']['feed_pk'])
+
+    def filter_substring(self, queryset, name, value):
+        # orders.search imports the models, which import this module
+        from orders.search import filter_substring
+        return filter_substring(queryset, name, value, feed_id=self.feed_id)
+
     def datetime_from_epoch(self, value):
         return datetime.utcfromtimestamp(float(value))
 
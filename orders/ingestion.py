@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncWeek
+from orders import dimensions
+from orders.models import Line, Summary, WeeklyRollup
+from orders.parsing import get_line_content_hash, get_line_key_hash, parse_row
+from orders.search import build_line_trigrams
+
+
+def ingest_rows(feed, rows, batch_size=None, progress=None):
+    """
+    Creates the lines, weekly summaries and search trigrams of 'feed' from an iterable of row values.
+    See ingest_lines.
+    """
+    return ingest_lines(feed, (parse_row(row) for row in rows), batch_size=batch_size, progress=progress)
+
+
+def ingest_lines(feed, parsed_rows, batch_size=None, progress=None):
+    """
+    Creates the lines, weekly summaries and search trigrams of 'feed' from an iterable of parse_row results,
+    None for skipped rows, writing them with multi-row inserts of 'batch_size' objects.
+    'progress' is called with the running stats after every batch.
+    Must be called inside a transaction.
+    """
+    batch_size = batch_size or settings.FEED_INGEST_BATCH_SIZE
+    stats = {'rows_processed': 0, 'rows_skipped': 0, 'lines': 0, 'summaries': 0, 'rollups': 0, 'trigrams': 0}
+    buyer_ids, planner_ids = set(), set()
+    lines = []
+    for values in parsed_rows:
+        stats['rows_processed'] += 1
+        if values is None:
+            stats['rows_skipped'] += 1
+            continue
+
+        buyer_code = values.pop('buyer_code')
+        planner_code = values.pop('planner_code')
+        line = Line(
+            feed=feed,
+            buyer_id=dimensions.buyers.get_by_code(buyer_code).id,
+            planner_id=dimensions.planners.get_by_code(planner_code if planner_code is not None else buyer_code).id,
+            **values
+        )
+        lines.append(line)
+        buyer_ids.add(line.buyer_id)
+        planner_ids.add(line.planner_id)
+        if len(lines) >= batch_size:
+            Line.objects.bulk_create(lines)
+            stats['lines'] += len(lines)
+            lines = []
+            if progress is not None:
+                progress(stats)
+
+    if lines:
+        Line.objects.bulk_create(lines)
+        stats['lines'] += len(lines)
+
+    feed.buyers.set(buyer_ids)
+    feed.planners.set(planner_ids)
+    stats['summaries'] = rebuild_summaries(feed, batch_size=batch_size)
+    stats['rollups'] = rebuild_rollups(feed, batch_size=batch_size)
+    stats['trigrams'] = build_line_trigrams(feed, batch_size=batch_size)
+    if progress is not None:
+        progress(stats)
+
+    return stats
+
+
+def rebuild_summaries(feed, batch_size=None):
+    """
+    Replaces the weekly summaries of 'feed' with the totals of its lines per week (starting on Monday)
+    and buyer, computed with a single GROUP BY and written with a single multi-row insert.
+    Returns the number of summaries.
+    """
+    totals = Line.objects.filter(feed=feed, confirmed_shipping__isnull=False) \
+        .annotate(start_date=TruncWeek('confirmed_shipping')) \
+        .values('start_date', 'buyer') \
+        .annotate(total_quantity=Sum('quantity'), total_extended_quantity=Sum('extended_quantity')) \
+        .order_by('start_date', 'buyer')
+    summaries = [
+        Summary(
+            feed=feed,
+            start_date=total['start_date'],
+            buyer_id=total['buyer'],
+            quantity=int(total['total_quantity']),
+            extended_quantity=int(total['total_extended_quantity']),
+        )
+        for total in totals
+    ]
+    Summary.objects.filter(feed=feed).delete()
+    Summary.objects.bulk_create(summaries, batch_size=batch_size or settings.FEED_INGEST_BATCH_SIZE)
+    # the cached summary report and responses were built from the previous summaries
+    feed.clear_summary_export()
+    feed.bump_version()
+    return len(summaries)
+
+
+def rebuild_rollups(feed, batch_size=None):
+    """
+    Replaces the weekly rollups of 'feed' with the totals of its lines per week, buyer and planner,
+    computed with a single GROUP BY. Returns the number of rollups.
+    """
+    totals = Line.objects.filter(feed=feed, confirmed_shipping__isnull=False) \
+        .annotate(start_date=TruncWeek('confirmed_shipping')) \
+        .values('start_date', 'buyer', 'planner') \
+        .annotate(total_quantity=Sum('quantity'), total_extended_quantity=Sum('extended_quantity'),
+                  total_net_amount=Sum('net_amount'), total_lines=Count('id')) \
+        .order_by('start_date', 'buyer', 'planner')
+    rollups = [
+        WeeklyRollup(
+            feed=feed,
+            start_date=total['start_date'],
+            buyer_id=total['buyer'],
+            planner_id=total['planner'],
+            quantity=int(total['total_quantity']),
+            extended_quantity=int(total['total_extended_quantity']),
+            net_amount=total['total_net_amount'],
+            lines=total['total_lines'],
+        )
+        for total in totals
+    ]
+    WeeklyRollup.objects.filter(feed=feed).delete()
+    WeeklyRollup.objects.bulk_create(rollups, batch_size=batch_size or settings.FEED_INGEST_BATCH_SIZE)
+    return len(rollups)
+
+
+def ensure_line_hashes(feed, batch_size=None):
+    """
+    Computes the key and content hashes of lines of 'feed' ingested before they were stored.
+    """
+    batch_size = batch_size or settings.FEED_INGEST_BATCH_SIZE
+    queryset = feed.lines.filter(key_hash__isnull=True).only(
+        'id', 'sales_order_number', 'item_number', 'purchase_order_number', 'confirmed_shipping', 'quantity', 'note')
+    lines = []
+    for line in queryset.iterator(chunk_size=batch_size):
+        line.key_hash = get_line_key_hash(line.sales_order_number, line.item_number, line.purchase_order_number)
+        line.content_hash = get_line_content_hash(line.confirmed_shipping, line.quantity, line.note)
+        lines.append(line)
+        if len(lines) >= batch_size:
+            Line.objects.bulk_update(lines, ('key_hash', 'content_hash',))
+            lines = []
+
+    if lines:
+        Line.objects.bulk_update(lines, ('key_hash', 'content_hash',))
@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from orders.ingestion import ingest_lines
+from orders.models import Feed, IngestionJob
+from orders.parsing import read_feed_lines
+
+logger = logging.getLogger(__name__)
+
+# progress is written on its own connection so it's visible while the ingestion transaction is still open
+PROGRESS_DB = 'progress'
+
+_executor = None
+_poller = None
+_lock = threading.Lock()
+# jobs submitted to the pool and not finished yet
+_busy = 0
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.FEED_INGEST_WORKERS, thread_name_prefix='ingest')
+
+    return _executor
+
+
+def release_slot(future):
+    global _busy
+    with _lock:
+        _busy -= 1
+
+
+def submit(func, *args):
+    global _busy
+    with _lock:
+        _busy += 1
+
+    get_executor().submit(func, *args).add_done_callback(release_slot)
+
+
+def poll_jobs():
+    # jobs left pending or abandoned by another process are only found by polling
+    while True:
+        with _lock:
+            free = settings.FEED_INGEST_WORKERS - _busy
+
+        for _ in range(free):
+            submit(run_next_jobs)
+
+        time.sleep(settings.INGEST_JOB_POLL_INTERVAL)
+
+
+def start_job_poller():
+    """
+    Starts polling for claimable jobs every INGEST_JOB_POLL_INTERVAL seconds in this process, once.
+    Called in each server worker once it's forked and on the first upload of processes without one.
+    """
+    global _poller
+    if settings.FEED_INGEST_WORKERS <= 0:
+        return
+
+    with _lock:
+        if _poller is None:
+            _poller = threading.Thread(target=poll_jobs, name='ingest-poller', daemon=True)
+            _poller.start()
+
+
+def enqueue_feed(feed):
+    """
+    Creates the ingestion job of 'feed'. Once the current transaction commits, the job is handed
+    to the local worker pool, or left pending for the ingest_worker command if the pool is disabled.
+    """
+    job = IngestionJob.objects.create(feed=feed)
+    if settings.FEED_INGEST_WORKERS > 0:
+        start_job_poller()
+        transaction.on_commit(lambda: submit(run_job, job.id))
+
+    return job
+
+
+def get_stale_before():
+    return timezone.now() - timedelta(seconds=settings.INGEST_JOB_LEASE)
+
+
+def get_abandoned_filter():
+    """
+    Running jobs whose worker hasn't sent a heartbeat for INGEST_JOB_LEASE seconds, e.g. because its
+    process was killed. The transaction of an abandoned job was rolled back with it.
+    """
+    stale = get_stale_before()
+    return Q(state=IngestionJob.RUNNING, heartbeat_at__lt=stale) | \
+        Q(state=IngestionJob.RUNNING, heartbeat_at__isnull=True, started_at__lt=stale)
+
+
+def get_claimable_filter():
+    return Q(state=IngestionJob.PENDING) | get_abandoned_filter()
+
+
+def claim_job(job_id):
+    now = timezone.now()
+    claimed = IngestionJob.objects.filter(get_claimable_filter(), id=job_id).update(
+        state=IngestionJob.RUNNING, started_at=now, heartbeat_at=now, rows_processed=0, rows_skipped=0,
+        lines_inserted=0, summaries_written=0)
+    return claimed == 1
+
+
+def claim_next_job():
+    for job_id in IngestionJob.objects.filter(get_claimable_filter()).values_list('id', flat=True)[:10]:
+        if claim_job(job_id):
+            return job_id
+
+    return None
+
+
+@contextmanager
+def renewing_lease(job_id):
+    stop = threading.Event()
+    threading.Thread(target=send_heartbeats, args=(job_id, stop), name=f'ingest-heartbeat-{job_id}', daemon=True).start()
+    try:
+        yield
+
+    finally:
+        stop.set()
+
+
+def requeue_abandoned_job(job):
+    """
+    Hands 'job' to the pool again when it was abandoned or has been pending for longer than a lease, so the
+    re-uploads of its file don't keep returning a job that won't finish. Returns whether it was requeued.
+    """
+    stale_pending = Q(state=IngestionJob.PENDING, created_at__lt=get_stale_before())
+    requeued = IngestionJob.objects.filter(stale_pending | get_abandoned_filter(), id=job.id) \
+        .update(state=IngestionJob.PENDING, heartbeat_at=None)
+    if requeued and settings.FEED_INGEST_WORKERS > 0:
+        start_job_poller()
+        transaction.on_commit(lambda: submit(run_job, job.id))
+
+    return requeued == 1
+
+
+def send_heartbeats(job_id, stop):
+    # renews the lease of the job until it's finished, on a connection of its own
+    try:
+        while not stop.wait(settings.INGEST_JOB_HEARTBEAT):
+            try:
+                IngestionJob.objects.using(PROGRESS_DB).filter(id=job_id, state=IngestionJob.RUNNING) \
+                    .update(heartbeat_at=timezone.now())
+
+            except DatabaseError:
+                logger.warning('Could not renew the lease of ingestion job %s', job_id)
+
+    finally:
+        connections.close_all()
+
+
+def process_job(job_id):
+    job = IngestionJob.objects.select_related('feed').get(id=job_id)
+    progress_qs = IngestionJob.objects.using(PROGRESS_DB).filter(id=job_id)
+
+    def report(stats):
+        # progress is informative only, it must never abort the ingestion
+        try:
+            progress_qs.update(rows_processed=stats['rows_processed'], rows_skipped=stats['rows_skipped'],
+                               lines_inserted=stats['lines'], summaries_written=stats['summaries'])
+
+        except DatabaseError:
+            logger.warning('Could not publish the progress of ingestion job %s', job_id)
+
+    with renewing_lease(job_id):
+        try:
+            with transaction.atomic():
+                stats = ingest_lines(job.feed, read_feed_lines(job.feed.file.name), progress=report)
+                Feed.objects.filter(id=job.feed_id).update(ingested=True)
+                job.feed.bump_version()
+
+        except Exception as e:
+            logger.exception('Ingestion of feed %s failed', job.feed_id)
+            # a failed feed must not be returned for re-uploads of the same file
+            Feed.objects.filter(id=job.feed_id).update(checksum=None)
+            progress_qs.update(state=IngestionJob.FAILED, error=str(e), finished_at=timezone.now())
+            return
+
+        progress_qs.update(
+            state=IngestionJob.DONE,
+            rows_processed=stats['rows_processed'],
+            rows_skipped=stats['rows_skipped'],
+            lines_inserted=stats['lines'],
+            summaries_written=stats['summaries'],
+            finished_at=timezone.now(),
+        )
+
+    prewarm_summary_export(job.feed_id)
+
+
+def prewarm_summary_export(feed_id):
+    # renders the summary report ahead of its first request, a failure only costs that request the rendering
+    try:
+        Feed.objects.select_related('uploaded_by').get(id=feed_id).get_summary_export().close()
+
+    except Exception:
+        logger.exception('Could not prewarm the summary report of feed %s', feed_id)
+
+
+def run_next_jobs():
+    try:
+        while True:
+            job_id = claim_next_job()
+            if job_id is None:
+                return
+
+            process_job(job_id)
+
+    finally:
+        connections.close_all()
+
+
+def run_job(job_id):
+    try:
+        if claim_job(job_id):
+            process_job(job_id)
+
+    finally:
+        # worker threads own their connections
+        connections.close_all()
@@ -0,0 +1,117 @@
+import json
+import os
+import platform
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from orders.benchmarks import SEARCH_TERMS, generate_rows, rolled_back, create_feed, get_peak_rss, benchmark_feed, \
+    benchmark_ingestion, benchmark_order_serialization, benchmark_parsing, benchmark_search
+
+
+class Command(BaseCommand):
+    help = 'Runs performance benchmarks against the configured database. All data written is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=('ingest', 'orders', 'search', 'feed', 'parse',))
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--batch-size', type=int, default=settings.FEED_INGEST_BATCH_SIZE)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 5000],
+                            help='Page sizes of the orders and feed suites.')
+        parser.add_argument('--repeat', type=int, default=3, help='Requests per page size of the feed suite, the median is kept.')
+        parser.add_argument('--no-exports', action='store_false', dest='exports', help='Skip the PDF exports of the feed suite.')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                            help='Parsing process counts of the parse suite, 1 parses in this process.')
+        parser.add_argument('--output', default=None, help='Writes the results as JSON to this file, to compare runs.')
+
+    def handle(self, *args, **options):
+        self.results = []
+        started_at = timezone.now()
+        getattr(self, f'run_{options["suite"]}')(options)
+        if options['output']:
+            with open(options['output'], 'w') as dst:
+                json.dump({
+                    'suite': options['suite'],
+                    'started_at': started_at.isoformat(),
+                    'database': connection.vendor,
+                    'python': platform.python_version(),
+                    'cpus': os.cpu_count(),
+                    'options': {name: options[name] for name in ('rows', 'batch_size', 'seed', 'sizes', 'repeat', 'exports', 'workers')},
+                    'peak_rss': get_peak_rss(),
+                    'results': self.results,
+                }, dst, indent=2)
+
+            self.stdout.write(f'Results written to {options["output"]}')
+
+    def record(self, **result):
+        result['peak_rss'] = get_peak_rss()
+        self.results.append(result)
+        return result
+
+    def run_ingest(self, options):
+        rows = list(generate_rows(options['rows'], seed=options['seed']))
+        for (label, batch_size) in (('row by row', 1), ('batched', options['batch_size'])):
+            elapsed, stats = benchmark_ingestion(rows, batch_size)
+            self.record(stage='ingest', batch_size=batch_size, elapsed=elapsed, **stats)
+            self.stdout.write(
+                f'{label:>12} (batch size {batch_size}): {stats["lines"]} lines, '
+                f'{stats["summaries"]} summaries in {elapsed:.2f}s ({stats["rows_processed"] / elapsed:,.0f} rows/s)'
+            )
+
+    def run_orders(self, options):
+        with rolled_back():
+            feed, _ = create_feed(generate_rows(max(options['sizes']) * 2, seed=options['seed']))
+            for (size, path, elapsed, queries) in benchmark_order_serialization(feed, options['sizes']):
+                self.record(stage='serialization', path=path, lines=size, elapsed=elapsed, queries=queries)
+                self.stdout.write(f'{size:>6} lines, {path:>17}: {elapsed * 1000:8.1f}ms, {queries} queries')
+
+    def run_search(self, options):
+        with rolled_back():
+            feed, stats = create_feed(generate_rows(options['rows'], seed=options['seed']), batch_size=options['batch_size'])
+            self.stdout.write(f'{stats["lines"]} lines, {stats["trigrams"]} trigrams')
+            for (name, term, matches, plain, indexed, same) in benchmark_search(feed, SEARCH_TERMS):
+                if not same:
+                    raise CommandError(f'The trigram search of {term!r} in {name} differs from icontains')
+
+                self.record(stage='search', field=name, term=term, matches=matches, icontains=plain, trigrams=indexed)
+                self.stdout.write(
+                    f'{name:>18} {term!r:>10}: {matches:>7} lines, '
+                    f'icontains {plain * 1000:8.1f}ms, trigrams {indexed * 1000:8.1f}ms'
+                )
+
+    def run_feed(self, options):
+        rows = generate_rows(options['rows'], seed=options['seed'])
+        try:
+            for result in benchmark_feed(rows, options['sizes'], repeat=options['repeat'], exports=options['exports']):
+                self.stdout.write(self.describe(self.record(**result)))
+
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+    def run_parse(self, options):
+        single = None
+        for (workers, elapsed, rows, same) in benchmark_parsing(generate_rows(options['rows'], seed=options['seed']), options['workers']):
+            if not same:
+                raise CommandError(f'Parsing with {workers} processes differs from the first run')
+
+            single = single or elapsed
+            self.record(stage='parse', workers=workers, rows=rows, elapsed=elapsed, speedup=single / elapsed)
+            self.stdout.write(
+                f'{workers:>3} processes: {rows} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s), '
+                f'{single / elapsed:.2f}x the first run'
+            )
+
+    def describe(self, result):
+        stage = result['stage']
+        timing = f'{result["elapsed"] * 1000:9.1f}ms, {result["queries"]:>4} queries, peak RSS {result["peak_rss"] / 2 ** 20:,.0f}MB'
+        if stage == 'upload':
+            return f'{"upload":>22} ({result["bytes"] / 2 ** 20:,.1f}MB): {timing}'
+
+        if stage == 'ingest':
+            return f'{"ingest":>22} ({result["rows"]} rows, {result["rows_per_second"]:,.0f} rows/s): {timing}'
+
+        if stage == 'orders_list':
+            return f'{"orders " + result["mode"]:>22} ({result["page_size"]} lines): {timing}'
+
+        return f'{stage:>22} ({result["bytes"] / 1024:,.0f}KB): {timing}'
@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from orders.jobs import claim_next_job, process_job
+
+
+class Command(BaseCommand):
+    help = 'Processes pending feed ingestion jobs and the running ones abandoned by killed processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once there are no pending jobs left.')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds to wait between polls.')
+
+    def handle(self, *args, **options):
+        while True:
+            job_id = claim_next_job()
+            if job_id is not None:
+                self.stdout.write(f'Processing ingestion job {job_id}')
+                process_job(job_id)
+                continue
+
+            if options['once']:
+                break
+
+            time.sleep(options['interval'])
@@ -0,0 +1,66 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        'Starts the production server with gunicorn.conf.py and measures the time until it answers its first '
+        'request, failing when it is over STARTUP_TARGET_SECONDS.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--app', default='casper.wsgi:application')
+        parser.add_argument('--bind', default='127.0.0.1:8765')
+        parser.add_argument('--path', default='/ping/')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--worker-class', default=None, help='Overrides GUNICORN_WORKER_CLASS.')
+        parser.add_argument('--target', type=float, default=settings.STARTUP_TARGET_SECONDS)
+        parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for the first response.')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, GUNICORN_BIND=options['bind'], GUNICORN_WORKERS=str(options['workers']))
+        if options['worker_class']:
+            env['GUNICORN_WORKER_CLASS'] = options['worker_class']
+
+        url = f'http://{options["bind"]}{options["path"]}'
+        started_at = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', str(settings.BASE_DIR / 'gunicorn.conf.py'), options['app']],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        try:
+            status = self.wait_for_response(server, url, started_at + options['timeout'])
+            elapsed = time.perf_counter() - started_at
+
+        finally:
+            server.send_signal(signal.SIGTERM)
+            _, errors = server.communicate(timeout=30)
+
+        if status is None:
+            raise CommandError(f'No response from {url} within {options["timeout"]:.0f}s:\n{errors.decode("utf-8", "replace")}')
+
+        self.stdout.write(f'First response ({status}) from {url} after {elapsed:.2f}s, target {options["target"]:.2f}s')
+        if elapsed > options['target']:
+            raise CommandError(f'The server took {elapsed:.2f}s to answer, over the {options["target"]:.2f}s target')
+
+    def wait_for_response(self, server, url, deadline):
+        # any HTTP response counts, e.g. a 400 when the bind address isn't in ALLOWED_HOSTS
+        while time.perf_counter() < deadline and server.poll() is None:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    return response.status
+
+            except urllib.error.HTTPError as e:
+                return e.code
+
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.05)
+
+        return None
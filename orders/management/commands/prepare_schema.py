@@ -0,0 +1,36 @@
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.questioner import NonInteractiveMigrationQuestioner
+from django.db.migrations.state import ProjectState
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs makemigrations and migrate only when there are model changes or unapplied migrations, '
+        'so a start with a current schema costs one check in a single process.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        executor = MigrationExecutor(connections[options['database']])
+        # the same detection as makemigrations, which skips apps without a migrations package
+        autodetector = MigrationAutodetector(
+            executor.loader.project_state(),
+            ProjectState.from_apps(apps),
+            NonInteractiveMigrationQuestioner(dry_run=True),
+        )
+        if autodetector.changes(graph=executor.loader.graph):
+            call_command('makemigrations', interactive=False, verbosity=options['verbosity'])
+            executor.loader.build_graph()
+
+        if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+            call_command('migrate', database=options['database'], interactive=False, verbosity=options['verbosity'])
+            return
+
+        self.stdout.write('The schema is current, nothing to migrate.')
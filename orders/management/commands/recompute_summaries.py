@@ -0,0 +1,42 @@
+from multiprocessing import Pool
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from orders.ingestion import rebuild_rollups, rebuild_summaries
+from orders.models import Feed
+
+
+def recompute_feed(feed_id):
+    try:
+        with transaction.atomic():
+            feed = Feed.objects.get(id=feed_id)
+            return feed_id, rebuild_summaries(feed), rebuild_rollups(feed)
+
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the weekly summaries and rollups of one or more feeds (all feeds by default) from their lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--feed', type=int, nargs='*', dest='feeds', help='Ids of the feeds to recompute.')
+        parser.add_argument('--processes', type=int, default=None, help='Size of the process pool, defaults to the CPU count.')
+
+    def handle(self, *args, **options):
+        queryset = Feed.objects.filter(ingested=True)
+        if options['feeds']:
+            queryset = queryset.filter(id__in=options['feeds'])
+
+        feed_ids = list(queryset.values_list('id', flat=True))
+        if options['processes'] == 1:
+            self.report(map(recompute_feed, feed_ids))
+            return
+
+        # forked workers must not share the connections of this process
+        connections.close_all()
+        with Pool(processes=options['processes']) as pool:
+            self.report(pool.imap_unordered(recompute_feed, feed_ids))
+
+    def report(self, results):
+        for (feed_id, summaries, rollups) in results:
+            self.stdout.write(f'Feed {feed_id}: {summaries} summaries, {rollups} rollups')
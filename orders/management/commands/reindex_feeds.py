@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from orders.ingestion import ensure_line_hashes
+from orders.models import Feed
+from orders.search import build_line_trigrams
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the data derived from the lines of feeds at ingest (buyer and planner sets, line hashes, search trigrams).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--feed', type=int, nargs='*', dest='feeds', help='Ids of the feeds to reindex.')
+        parser.add_argument('--trigrams', action='store_true', help='Rebuild the search trigrams of feeds already indexed.')
+
+    def handle(self, *args, **options):
+        queryset = Feed.objects.filter(ingested=True)
+        if options['feeds']:
+            queryset = queryset.filter(id__in=options['feeds'])
+
+        for feed in queryset.only('id', 'search_indexed').iterator():
+            with transaction.atomic():
+                feed.refresh_buyers_and_planners()
+                ensure_line_hashes(feed)
+                if options['trigrams'] or not feed.search_indexed:
+                    build_line_trigrams(feed)
+
+                feed.bump_version()
+
+            self.stdout.write(f'Feed {feed.id} reindexed')
@@ -1,9 +1,11 @@
 import hashlib
 import uuid
-from base64 import b64encode
+from django.core.files.base import ContentFile
 from django.template.loader import render_to_string
-from easy_pdf.rendering import render_to_pdf
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+from orders.exports import get_filter_params, get_orders_export_name, get_cached_export
+from orders.rendering import render_pdf, render_pdf_chunks
 from orders.tasks import generate_summary_context, generate_orders_export
 
 
@@ -11,6 +13,10 @@ def get_uuid_filename(_, filename):
     return f'feeds/{uuid.uuid4()}/{filename}'
 
 
+def get_summary_filename(_, filename):
+    return f'summaries/{uuid.uuid4()}/{filename}'
+
+
 def get_file_checksum(src):
     if src:
         hash_md5 = hashlib.md5()
@@ -28,7 +34,17 @@ class Feed(models.Model):
     filename = models.CharField(max_length=255, blank=False, null=False)
     uploaded_by = models.ForeignKey(
         'users.User', null=True, blank=True, on_delete=models.CASCADE)
-    summary_export = models.TextField(null=True, blank=True, default=None)
+    # cached summary report, cleared when the summaries are rebuilt
+    summary_file = models.FileField(upload_to=get_summary_filename, null=True, blank=True, default=None)
+    ingested = models.BooleanField(null=False, blank=False, default=True)
+    checksum = models.CharField(max_length=32, null=True, blank=True, default=None, unique=True)
+    # buyers and planners found in the lines of the feed, stored at ingest
+    buyers = models.ManyToManyField('orders.Buyer', blank=True, related_name='feeds')
+    planners = models.ManyToManyField('orders.Planner', blank=True, related_name='feeds')
+    # bumped whenever the data served for the feed changes, part of the ETags of its resources
+    version = models.PositiveIntegerField(null=False, blank=False, default=0)
+    # the search trigrams of the lines were built, substring searches of feeds without them use icontains
+    search_indexed = models.BooleanField(null=False, blank=False, default=False)
     created_at = models.DateTimeField(null=True, blank=True, auto_now_add=True)
     updated_at = models.DateTimeField(null=True, blank=True, auto_now=True)
 
@@ -43,27 +59,65 @@ class Feed(models.Model):
         return get_file_checksum(self.file)
 
     def get_distinct_buyers(self):
-        buyer_ids = self.lines.all().order_by('buyer').values_list('buyer', flat=True).distinct()
-        return Buyer.objects.filter(id__in=buyer_ids)
+        return self.buyers.all()
 
     def get_distinct_planners(self):
-        planner_ids = self.lines.all().order_by('planner').values_list('planner', flat=True).distinct()
-        return Planner.objects.filter(id__in=planner_ids)
+        return self.planners.all()
+
+    def refresh_buyers_and_planners(self):
+        self.buyers.set(self.lines.order_by('buyer').values_list('buyer', flat=True).distinct())
+        self.planners.set(self.lines.order_by('planner').values_list('planner', flat=True).distinct())
+
+    def bump_version(self):
+        """
+        Invalidates the cached responses for the feed, the version and the modification time are
+        updated in place so concurrent bumps are not lost.
+        """
+        self.updated_at = timezone.now()
+        Feed.objects.filter(id=self.id).update(version=models.F('version') + 1, updated_at=self.updated_at)
+        self.version = Feed.objects.filter(id=self.id).values_list('version', flat=True).first()
 
     def get_summary_export(self):
-        if self.summary_export is None:
-            ctx = generate_summary_context(feed=self)
-            pdf_bytes = render_to_pdf('reports/summary.html', ctx)
-            self.summary_export = b64encode(pdf_bytes).decode('ascii')
-            self.save()
+        """
+        Returns the summary report PDF as an open file, it's rendered on first use and kept until
+        the summaries of the feed are rebuilt.
+        """
+        if self.summary_file:
+            try:
+                return self.summary_file.storage.open(self.summary_file.name, 'rb')
+
+            except FileNotFoundError:
+                pass
 
-        return self.summary_export
+        ctx = generate_summary_context(feed=self)
+        pdf_bytes = render_pdf('reports/summary.html', ctx)
+        self.summary_file.save(f'summary-{self.id}.pdf', ContentFile(pdf_bytes), save=False)
+        Feed.objects.filter(id=self.id).update(summary_file=self.summary_file.name)
+        return self.summary_file.storage.open(self.summary_file.name, 'rb')
 
-    def get_orders_export(self, query_params=''):
-        ctx = generate_orders_export(feed=self, query_params=query_params)
-        pdf_bytes = render_to_pdf('reports/orders.html', ctx)
-        orders_export = b64encode(pdf_bytes).decode('ascii')
-        return orders_export
+    def clear_summary_export(self):
+        """
+        Drops the cached summary report, its file is deleted once the current transaction commits.
+        """
+        name = Feed.objects.filter(id=self.id).values_list('summary_file', flat=True).first()
+        Feed.objects.filter(id=self.id).update(summary_file=None)
+        self.summary_file = None
+        if name:
+            storage = self.summary_file.storage
+            transaction.on_commit(lambda: storage.delete(name))
+
+    def get_orders_export(self, query_params=None):
+        """
+        Returns the orders report PDF of the lines matching the LineFilter 'query_params' as an open file,
+        feeds don't change after upload so it's rendered once per distinct filter.
+        """
+        params = get_filter_params(query_params or {})
+
+        def render(dst):
+            contexts = generate_orders_export(feed=self, query_params=params)
+            render_pdf_chunks('reports/orders.html', contexts, dst)
+
+        return get_cached_export(get_orders_export_name(self, params), render)
 
     def __str__(self):
         return self.filename
@@ -72,6 +126,16 @@ class Feed(models.Model):
 class Line(models.Model):
     class Meta:
         ordering = ['id', ]
+        # lines are always read within a feed, the id suffix serves the ordering tie-breaker and keyset pages
+        indexes = [
+            models.Index(fields=['feed', 'key_hash'], name='line_feed_key_hash_idx'),
+            models.Index(fields=['feed', 'confirmed_shipping', 'id'], name='line_feed_shipping_idx'),
+            models.Index(fields=['feed', 'buyer', 'id'], name='line_feed_buyer_idx'),
+            models.Index(fields=['feed', 'planner', 'id'], name='line_feed_planner_idx'),
+            models.Index(fields=['feed', 'sales_order_number', 'id'], name='line_feed_so_idx'),
+            models.Index(fields=['feed', 'purchase_order_number', 'id'], name='line_feed_po_idx'),
+            models.Index(fields=['feed', 'item_number', 'id'], name='line_feed_item_idx'),
+        ]
 
     feed = models.ForeignKey('orders.Feed', null=False,
                              blank=False, on_delete=models.CASCADE, related_name='lines')
@@ -106,13 +170,54 @@ class Line(models.Model):
     created_at = models.DateTimeField(null=False, blank=False)
     updated_at = models.DateTimeField(null=False, blank=False)
     revision = models.CharField(max_length=8, null=False, blank=False)
+    # hashes of (sales order, item, purchase order) and of the fields compared between feeds
+    key_hash = models.BigIntegerField(null=True, blank=True, default=None)
+    content_hash = models.BigIntegerField(null=True, blank=True, default=None)
+
+
+class LineTrigram(models.Model):
+    """
+    Trigrams of the normalized searchable text fields of a line, one row per distinct trigram.
+    """
+    ITEM_NUMBER = 1
+    NOTE = 2
+    CUSTOMER_REFERENCE = 3
+    FIELD_CHOICES = (
+        (ITEM_NUMBER, 'item_number'),
+        (NOTE, 'note'),
+        (CUSTOMER_REFERENCE, 'customer_reference'),
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['feed', 'field', 'trigram', 'line'], name='linetrigram_lookup_idx'),
+        ]
+
+    feed = models.ForeignKey('orders.Feed', null=False, blank=False, on_delete=models.CASCADE, related_name='+')
+    line = models.ForeignKey('orders.Line', null=False, blank=False, on_delete=models.CASCADE, related_name='trigrams')
+    field = models.PositiveSmallIntegerField(null=False, blank=False, choices=FIELD_CHOICES)
+    trigram = models.CharField(max_length=3, null=False, blank=False)
+
+
+class TrigramFrequency(models.Model):
+    """
+    Number of lines of a feed having a trigram in a searchable field, used to pick the trigrams to look up.
+    """
+
+    class Meta:
+        unique_together = (('feed', 'field', 'trigram'),)
+
+    feed = models.ForeignKey('orders.Feed', null=False, blank=False, on_delete=models.CASCADE, related_name='+')
+    field = models.PositiveSmallIntegerField(null=False, blank=False, choices=LineTrigram.FIELD_CHOICES)
+    trigram = models.CharField(max_length=3, null=False, blank=False)
+    lines = models.PositiveIntegerField(null=False, blank=False, default=0)
 
 
 class Buyer(models.Model):
     class Meta:
         ordering = ['code']
 
-    code = models.CharField(max_length=16, null=False, blank=False)
+    code = models.CharField(max_length=16, null=False, blank=False, unique=True)
     name = models.CharField(max_length=64, null=True, blank=False)
 
     def __str__(self):
@@ -123,16 +228,29 @@ class Planner(models.Model):
     class Meta:
         ordering = ['code']
 
-    code = models.CharField(max_length=16, null=False, blank=False)
+    code = models.CharField(max_length=16, null=False, blank=False, unique=True)
     name = models.CharField(max_length=64, null=True, blank=False)
 
     def __str__(self):
         return f'{self.id}: {self.code} ({self.name})'
 
 
+class DimensionVersion(models.Model):
+    """
+    Version stamp of a dimension table, bumped on every change so each process can tell its cached copy is stale.
+    """
+
+    name = models.CharField(max_length=32, null=False, blank=False, unique=True)
+    version = models.PositiveIntegerField(null=False, blank=False, default=0)
+
+
 class Summary(models.Model):
     class Meta:
         ordering = ['feed__id', 'start_date', ]
+        indexes = [
+            models.Index(fields=['feed', 'start_date', 'buyer'], name='summary_feed_start_idx'),
+        ]
+
     feed = models.ForeignKey('orders.Feed', null=False,
                              blank=False, related_name='summary', on_delete=models.CASCADE)
     buyer = models.ForeignKey(
@@ -141,3 +259,64 @@ class Summary(models.Model):
     quantity = models.PositiveIntegerField(null=False, blank=False, default=0)
     extended_quantity = models.PositiveIntegerField(
         null=False, blank=False, default=0)
+
+
+class WeeklyRollup(models.Model):
+    """
+    Totals of the lines of a feed per week (starting on Monday), buyer and planner, written at ingest
+    so trends across feeds don't read their lines.
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['feed', 'start_date', 'buyer', 'planner'], name='rollup_feed_week_idx'),
+        ]
+
+    feed = models.ForeignKey('orders.Feed', null=False, blank=False, on_delete=models.CASCADE, related_name='rollups')
+    start_date = models.DateField(null=False, blank=False)
+    buyer = models.ForeignKey('orders.Buyer', null=False, blank=False, on_delete=models.CASCADE, related_name='+')
+    planner = models.ForeignKey('orders.Planner', null=False, blank=False, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(null=False, blank=False, default=0)
+    extended_quantity = models.PositiveIntegerField(null=False, blank=False, default=0)
+    net_amount = models.DecimalField(null=False, blank=False, max_digits=14, decimal_places=2, default=0)
+    lines = models.PositiveIntegerField(null=False, blank=False, default=0)
+
+
+class IngestionJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    class Meta:
+        ordering = ['id', ]
+
+    feed = models.OneToOneField('orders.Feed', null=False, blank=False,
+                                related_name='job', on_delete=models.CASCADE)
+    state = models.CharField(max_length=16, null=False, blank=False,
+                             choices=STATE_CHOICES, default=PENDING, db_index=True)
+    rows_processed = models.PositiveIntegerField(null=False, blank=False, default=0)
+    rows_skipped = models.PositiveIntegerField(null=False, blank=False, default=0)
+    lines_inserted = models.PositiveIntegerField(null=False, blank=False, default=0)
+    summaries_written = models.PositiveIntegerField(null=False, blank=False, default=0)
+    error = models.TextField(null=True, blank=True, default=None)
+    created_at = models.DateTimeField(null=True, blank=True, auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True, default=None)
+    finished_at = models.DateTimeField(null=True, blank=True, default=None)
+    # renewed while the job runs, a running job without a recent heartbeat was abandoned and can be claimed again
+    heartbeat_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    def get_elapsed(self):
+        if self.started_at is None:
+            return None
+
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+    def __str__(self):
+        return f'{self.id}: {self.feed_id} ({self.state})'
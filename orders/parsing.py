@@ -0,0 +1,258 @@
+import multiprocessing
+import os
+import re
+from datetime import datetime
+from hashlib import blake2b
+from decimal import Decimal
+from queue import Empty
+from openpyxl import load_workbook
+from openpyxl.worksheet._reader import WorkSheetParser
+from django.conf import settings
+
+kit_re = re.compile(r'^EZ(?:C5E|C6|C6A|RD6|FP[RS|PM](?:6A|5E|6))\d{2,3}Q(\d{2,3})-\d{2}$')
+
+FEED_SITE = '104-CA'
+FEED_COLUMNS = 25
+
+
+def get_extended_quantity(quantity, buyer_code, item_number):
+    if buyer_code == 'ORT':
+        m = kit_re.match(item_number)
+        if m is not None:
+            return quantity * int(m.group(1))
+
+    return quantity
+
+
+def pad_row(row):
+    # rows missing from the worksheet are returned as an empty list
+    row = tuple(row)
+    if len(row) < FEED_COLUMNS:
+        row = row + (None,) * (FEED_COLUMNS - len(row))
+
+    return row
+
+
+def iter_worksheet_rows(wb):
+    try:
+        ws = wb.worksheets[0]
+        # the dimensions stored by some exporters are wrong, rows are padded below instead
+        ws.reset_dimensions()
+        for row in ws.iter_rows(values_only=True):
+            yield pad_row(row)
+
+    finally:
+        wb.close()
+
+
+def get_value_hash(*values):
+    """
+    Returns a signed 64 bit hash of 'values', stable across processes and database round trips.
+    """
+    normalized = []
+    for value in values:
+        if value is None:
+            value = ''
+
+        elif isinstance(value, datetime):
+            value = value.date()
+
+        normalized.append(str(value))
+
+    digest = blake2b('\x1f'.join(normalized).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def get_line_key_hash(sales_order_number, item_number, purchase_order_number):
+    return get_value_hash(sales_order_number, item_number, purchase_order_number)
+
+
+def get_line_content_hash(confirmed_shipping, quantity, note):
+    return get_value_hash(confirmed_shipping, quantity, note)
+
+
+def check_feed_file(src):
+    """
+    Raises InvalidFileException if 'src' (a path or file object) can't be opened as a workbook.
+    """
+    load_workbook(src, read_only=True).close()
+
+
+def read_feed_rows(filename):
+    """
+    Returns an iterator over the rows of the first worksheet of 'filename' as tuples of plain values,
+    padded to FEED_COLUMNS. The workbook is streamed in read-only mode, so memory use doesn't grow
+    with the size of the file. Raises InvalidFileException right away if the file can't be opened.
+    """
+    wb = load_workbook(filename, read_only=True, data_only=True)
+    return iter_worksheet_rows(wb)
+
+
+def parse_row(row):
+    """
+    Maps a feed row (a sequence of plain cell values) to the field values of a Line.
+    Returns None for rows that don't belong to the site or have no confirmed shipping date.
+    """
+    site = row[11]
+    confirmed_shipping = row[9]
+    if site != FEED_SITE or confirmed_shipping is None:
+        return None
+
+    quantity = int(float(row[5]))
+    buyer_code = row[18]
+    item_number = row[2]
+    note = row[10]
+    return {
+        'sales_order_number': row[0],
+        'item_number': item_number,
+        'revision': row[4],
+        'quantity': quantity,
+        'extended_quantity': get_extended_quantity(quantity, buyer_code, item_number),
+        'unit': row[6],
+        'requested_receipt': row[7],
+        'requested_shipping': row[8],
+        'confirmed_shipping': confirmed_shipping,
+        'note': note,
+        'site': site,
+        'ship_to_name': row[12],
+        'unit_price': Decimal(row[15]),
+        'net_amount': Decimal(row[16]),
+        'customer_reference': row[17],
+        'buyer_code': buyer_code,
+        'planner_code': row[19],
+        'sales_taker': row[20],
+        'purchase_order_number': row[21],
+        'original_commit_date': row[22],
+        'created_at': row[23],
+        'updated_at': row[24],
+        'key_hash': get_line_key_hash(row[0], item_number, row[21]),
+        'content_hash': get_line_content_hash(confirmed_shipping, quantity, note),
+    }
+
+
+class FeedPartParser(WorkSheetParser):
+    """
+    Worksheet parser that only reads the cells of the chunks of 'chunk_rows' rows of one part of the
+    worksheet, chunk n belongs to part n % parts. The cells of the other rows are skipped, their
+    number is returned with None instead.
+    """
+
+    def __init__(self, src, shared_strings, part, parts, chunk_rows, **kwargs):
+        super(FeedPartParser, self).__init__(src, shared_strings, **kwargs)
+        self.part = part
+        self.parts = parts
+        self.chunk_rows = chunk_rows
+
+    def parse_row(self, row):
+        index = row.get('r')
+        index = int(float(index)) if index is not None else self.row_counter + 1
+        if ((index - 1) // self.chunk_rows) % self.parts == self.part:
+            return super(FeedPartParser, self).parse_row(row)
+
+        self.row_counter = index
+        return index, None
+
+
+def parse_feed_part(filename, part, parts, chunk_rows, results):
+    """
+    Runs in a parsing process. Puts (chunk, parse_row results of its rows) on the 'results' queue for each
+    chunk of 'part' in order, rows missing from the worksheet included, then (None, None) once the whole
+    worksheet is read. An exception is put instead when the file or a row can't be parsed.
+    """
+    try:
+        wb = load_workbook(filename, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            src = ws._get_source()
+            # the arguments ReadOnlyWorksheet passes to its own parser
+            parser = FeedPartParser(src, ws._shared_strings, part, parts, chunk_rows,
+                                    data_only=True, epoch=wb.epoch, date_formats=wb._date_formats)
+            chunk, parsed_rows = part, []
+            index = 0
+            for (index, cells) in parser.parse():
+                while (index - 1) // chunk_rows > chunk:
+                    # a row past the chunk was read, the rest of it is missing from the worksheet
+                    parsed_rows.extend([None] * (chunk_rows - len(parsed_rows)))
+                    results.put((chunk, parsed_rows))
+                    chunk, parsed_rows = chunk + parts, []
+
+                if cells is not None:
+                    # rows missing from the worksheet
+                    parsed_rows.extend([None] * ((index - 1) % chunk_rows - len(parsed_rows)))
+                    parsed_rows.append(parse_row(pad_row(ws._get_row(cells, values_only=True))))
+
+            src.close()
+
+        finally:
+            wb.close()
+
+        if chunk <= (index - 1) // chunk_rows:
+            results.put((chunk, parsed_rows))
+
+        results.put((None, None))
+
+    except Exception as e:
+        results.put(e)
+
+
+def get_part_result(results, process):
+    while True:
+        try:
+            return results.get(timeout=1)
+
+        except Empty:
+            if not process.is_alive():
+                # the last result may have been written as the process exited
+                try:
+                    return results.get(timeout=1)
+
+                except Empty:
+                    raise RuntimeError(f'A feed parsing process exited with code {process.exitcode}')
+
+
+def iter_parallel_rows(filename, parts, chunk_rows):
+    context = multiprocessing.get_context('spawn')
+    # each part holds at most this many parsed chunks in memory ahead of the insertion
+    queues = [context.Queue(maxsize=2) for _ in range(parts)]
+    processes = [
+        context.Process(target=parse_feed_part, args=(filename, part, parts, chunk_rows, queues[part]), daemon=True)
+        for part in range(parts)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        chunk = 0
+        while True:
+            result = get_part_result(queues[chunk % parts], processes[chunk % parts])
+            if isinstance(result, Exception):
+                raise result
+
+            (result_chunk, parsed_rows) = result
+            if result_chunk is None:
+                return
+
+            yield from parsed_rows
+            chunk += 1
+
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def read_feed_lines(filename, workers=None):
+    """
+    Returns an iterator over the parse_row results of the rows of 'filename', None for skipped rows.
+    With 'workers' > 1, FEED_PARSE_WORKERS by default for files of at least FEED_PARSE_MIN_BYTES, the rows
+    are read and parsed by that many processes, each parsing every workers-th chunk of FEED_PARSE_CHUNK_ROWS
+    rows in a single pass over the worksheet, and the chunks are returned in order. The results are the
+    same as parsing read_feed_rows.
+    """
+    if workers is None:
+        workers = settings.FEED_PARSE_WORKERS if os.path.getsize(filename) >= settings.FEED_PARSE_MIN_BYTES else 1
+
+    if workers < 2:
+        return map(parse_row, read_feed_rows(filename))
+
+    return iter_parallel_rows(filename, workers, settings.FEED_PARSE_CHUNK_ROWS)
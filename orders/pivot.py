@@ -0,0 +1,106 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from orders import dimensions
+from orders.exports import get_filter_params
+from orders.filters import LineFilter
+from orders.models import Line
+
+# dimension: (expression, label of a grouped value)
+PIVOT_DIMENSIONS = {
+    'buyer': (F('buyer'), lambda value: dimensions.get_code(dimensions.buyers, value)),
+    'planner': (F('planner'), lambda value: dimensions.get_code(dimensions.planners, value)),
+    'item': (F('item_number'), None),
+    'ship_to': (F('ship_to_name'), None),
+    'week': (TruncWeek('confirmed_shipping'), None),
+    'month': (TruncMonth('confirmed_shipping'), None),
+}
+PIVOT_MEASURES = {
+    'quantity': Sum('quantity'),
+    'extended_quantity': Sum('extended_quantity'),
+    'net_amount': Sum('net_amount'),
+    'lines': Count('id'),
+}
+
+
+class InvalidPivot(ValueError):
+    pass
+
+
+def get_pivot_params(query_params):
+    rows = query_params.get('rows')
+    cols = query_params.get('cols') or None
+    measure = query_params.get('measure') or 'extended_quantity'
+    if rows not in PIVOT_DIMENSIONS or (cols is not None and cols not in PIVOT_DIMENSIONS):
+        raise InvalidPivot(f'rows and cols must be one of: {", ".join(PIVOT_DIMENSIONS)}.')
+
+    if rows == cols:
+        raise InvalidPivot('rows and cols must be different.')
+
+    if measure not in PIVOT_MEASURES:
+        raise InvalidPivot(f'measure must be one of: {", ".join(PIVOT_MEASURES)}.')
+
+    return rows, cols, measure
+
+
+def get_label(dimension, value):
+    label = PIVOT_DIMENSIONS[dimension][1]
+    if value is None or label is None:
+        return value
+
+    return label(value)
+
+
+def get_keys(dimension, values):
+    # sorted by label, lines without a value for the dimension go last
+    return sorted(set(values), key=lambda value: (value is None, get_label(dimension, value)))
+
+
+def compute_pivot(feed, rows, cols, measure, params):
+    """
+    Totals 'measure' over the lines of 'feed' matching the LineFilter 'params', grouped by the 'rows'
+    dimension and the optional 'cols' one with a single GROUP BY. Cells without lines are 0.
+    """
+    queryset = LineFilter(params, queryset=Line.objects.filter(feed=feed), feed=feed).qs
+    groups = {'pivot_row': PIVOT_DIMENSIONS[rows][0]}
+    if cols is not None:
+        groups['pivot_col'] = PIVOT_DIMENSIONS[cols][0]
+
+    totals = queryset.order_by().values(**groups).annotate(value=PIVOT_MEASURES[measure])
+    cells = {(total['pivot_row'], total.get('pivot_col')): total['value'] or 0 for total in totals}
+    row_keys = get_keys(rows, [row for (row, _) in cells])
+    col_keys = get_keys(cols, [col for (_, col) in cells]) if cols is not None else [None]
+    values = [[cells.get((row, col), 0) for col in col_keys] for row in row_keys]
+    return {
+        'rows': rows,
+        'cols': cols,
+        'measure': measure,
+        'row_keys': [get_label(rows, row) for row in row_keys],
+        'col_keys': [get_label(cols, col) for col in col_keys] if cols is not None else [measure],
+        'values': values,
+        'row_totals': [sum(row) for row in values],
+        'col_totals': [sum(column) for column in zip(*values)],
+        'total': sum(sum(row) for row in values),
+    }
+
+
+def get_pivot(feed, query_params):
+    """
+    Returns the pivot of the lines of 'feed' for the rows, cols and measure of 'query_params' filtered by
+    its LineFilter parameters, cached per feed version, buyer and planner versions and parameters for
+    PIVOT_CACHE_TIMEOUT seconds.
+    Raises InvalidPivot for unknown dimensions or measures.
+    """
+    rows, cols, measure = get_pivot_params(query_params)
+    params = get_filter_params(query_params)
+    digest = hashlib.sha256(f'{rows}:{cols}:{measure}:{params.urlencode()}'.encode('utf-8')).hexdigest()
+    # the labels of buyers and planners come from their caches
+    key = f'pivot:{feed.id}:{feed.version}:{dimensions.get_versions()}:{digest[:32]}'
+    pivot = cache.get(key)
+    if pivot is None:
+        pivot = compute_pivot(feed, rows, cols, measure, params)
+        cache.set(key, pivot, settings.PIVOT_CACHE_TIMEOUT)
+
+    return pivot
@@ -0,0 +1,273 @@
+import logging
+import math
+import multiprocessing
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from tempfile import TemporaryFile
+from django.conf import settings
+from django.template.loader import render_to_string
+from casper.metrics import timed
+from easy_pdf.rendering import html_to_pdf
+
+try:
+    from PyPDF2 import PdfMerger
+
+except ImportError:
+    # PyPDF2 < 2.0
+    from PyPDF2 import PdfFileMerger as PdfMerger
+
+logger = logging.getLogger(__name__)
+
+
+class RenderQueueFull(Exception):
+    """
+    Raised when PDF_RENDER_MAX_QUEUE jobs of this process are already waiting, 'retry_after' is a hint in seconds.
+    """
+
+    def __init__(self, retry_after):
+        super(RenderQueueFull, self).__init__('The PDF rendering queue is full.')
+        self.retry_after = retry_after
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def raise_render_timeout(signum, frame):
+    raise RenderTimeout('The PDF took too long to render.')
+
+
+def render_html(content, timeout, submitted_at):
+    """
+    Runs in a pool process. Returns the PDF of the html 'content' with the seconds the job waited
+    in the queue and the seconds it took to render. Raises RenderTimeout after 'timeout' seconds.
+    """
+    started_at = time.time()
+    signal.signal(signal.SIGALRM, raise_render_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        pdf = html_to_pdf(content)
+
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    return pdf, started_at - submitted_at, time.time() - started_at
+
+
+class PDFRenderer:
+    """
+    Renders PDFs in a bounded pool of processes, so xhtml2pdf doesn't hold the GIL of the API workers.
+    Templates are rendered to html in the calling thread, which owns the database connection. At most
+    'workers' + 'max_queue' renders are admitted at once, further ones are refused with RenderQueueFull.
+    Each server process has its own renderer, the limits of a host are these times the processes.
+    """
+
+    def __init__(self, workers, max_queue, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        # a job may be queued behind the chunks of every other admitted render
+        self.wait_timeout = timeout * (1 + workers + max_queue)
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'in_flight': 0,
+            'queue_wait_seconds': 0.0,
+            'render_seconds': 0.0,
+        }
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawned workers don't inherit the threads and database connections of the server
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+            return self.executor
+
+    def count(self, **values):
+        with self.lock:
+            for (name, value) in values.items():
+                self.metrics[name] += value
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics)
+
+    def get_retry_after(self):
+        metrics = self.get_metrics()
+        average = metrics['render_seconds'] / metrics['completed'] if metrics['completed'] else self.timeout
+        return max(1, math.ceil(average * metrics['in_flight'] / self.workers))
+
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            self.count(rejected=1)
+            raise RenderQueueFull(self.get_retry_after())
+
+        self.count(submitted=1, in_flight=1)
+
+    def release(self):
+        self.count(in_flight=-1)
+        self.slots.release()
+
+    def release_when_done(self, futures):
+        # the slot is held until the processes are free again, not until the caller stops waiting
+        running = [future for future in futures if not future.cancel()]
+        if not running:
+            self.release()
+            return
+
+        remaining = [len(running)]
+        lock = threading.Lock()
+
+        def done(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+
+            if last:
+                self.release()
+
+        for future in running:
+            future.add_done_callback(done)
+
+    def submit(self, content):
+        return self.get_executor().submit(render_html, content, self.timeout, time.time())
+
+    def wait(self, future, template):
+        try:
+            # the wait covers the time spent queued behind the other jobs
+            pdf, queue_wait, render_time = future.result(timeout=self.wait_timeout)
+
+        except (RenderTimeout, TimeoutError):
+            self.count(timed_out=1)
+            logger.warning('Rendering of %s timed out', template)
+            raise RenderTimeout('The PDF took too long to render.')
+
+        except BrokenProcessPool:
+            # a worker died, the next job starts a new pool
+            self.count(failed=1)
+            with self.lock:
+                self.executor = None
+
+            raise
+
+        except Exception:
+            self.count(failed=1)
+            raise
+
+        self.count(completed=1, queue_wait_seconds=queue_wait, render_seconds=render_time)
+        logger.debug('Rendered %s in %.2fs after waiting %.2fs', template, render_time, queue_wait)
+        return pdf
+
+    def render(self, template, context):
+        self.acquire()
+        futures = []
+        try:
+            futures.append(self.submit(render_to_string(template, context)))
+            return self.wait(futures[0], template)
+
+        finally:
+            self.release_when_done(futures)
+
+    def render_chunks(self, template, contexts, dst, parallelism):
+        """
+        Renders 'template' once per context of 'contexts' and writes the concatenated PDFs to 'dst'.
+        Up to 'parallelism' chunks render at once, the whole export takes a single queue slot.
+        """
+        self.acquire()
+        # only the futures not spooled yet are kept, a finished one holds the PDF of its chunk
+        pending = deque()
+        parts = []
+        try:
+            for context in contexts:
+                pending.append(self.submit(render_to_string(template, context)))
+                if len(pending) >= parallelism:
+                    parts.append(get_pdf_part(self.wait(pending[0], template)))
+                    pending.popleft()
+
+            while pending:
+                parts.append(get_pdf_part(self.wait(pending[0], template)))
+                pending.popleft()
+
+            merge_pdfs(parts, dst)
+
+        finally:
+            for part in parts:
+                part.close()
+
+            self.release_when_done(pending)
+
+
+def get_pdf_part(pdf):
+    part = TemporaryFile()
+    part.write(pdf)
+    part.seek(0)
+    return part
+
+
+def merge_pdfs(parts, dst):
+    merger = PdfMerger()
+    for part in parts:
+        merger.append(part)
+
+    merger.write(dst)
+    merger.close()
+
+
+_renderer = None
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = PDFRenderer(settings.PDF_RENDER_WORKERS, settings.PDF_RENDER_MAX_QUEUE, settings.PDF_RENDER_TIMEOUT)
+
+    return _renderer
+
+
+def render_pdf(template, context):
+    """
+    Renders the PDF of 'template' with 'context' in the rendering pool, or inline when
+    PDF_RENDER_WORKERS is 0.
+    """
+    with timed('pdf'):
+        if settings.PDF_RENDER_WORKERS == 0:
+            return html_to_pdf(render_to_string(template, context))
+
+        return get_renderer().render(template, context)
+
+
+def render_pdf_chunks(template, contexts, dst):
+    """
+    Renders 'template' with each context of 'contexts' as an independent PDF, in the rendering pool
+    PDF_RENDER_WORKERS at a time, and writes them concatenated to the file object 'dst'. Only the
+    chunks being rendered are held in memory, finished ones are spooled to temporary files.
+    """
+    with timed('pdf'):
+        if settings.PDF_RENDER_WORKERS == 0:
+            render_chunks_inline(template, contexts, dst)
+
+        else:
+            get_renderer().render_chunks(template, contexts, dst, settings.PDF_RENDER_WORKERS)
+
+
+def render_chunks_inline(template, contexts, dst):
+    parts = []
+    try:
+        for context in contexts:
+            parts.append(get_pdf_part(html_to_pdf(render_to_string(template, context))))
+
+        merge_pdfs(parts, dst)
+
+    finally:
+        for part in parts:
+            part.close()
@@ -0,0 +1,95 @@
+import unicodedata
+from collections import Counter
+from django.conf import settings
+from django.db.models import Count
+from orders.models import Feed, Line, LineTrigram, TrigramFrequency
+
+SEARCH_FIELDS = {name: field for (field, name) in LineTrigram.FIELD_CHOICES}
+# trigrams looked up per search, the rarest ones in the feed
+SEARCH_TRIGRAMS = 2
+
+
+def normalize_text(value):
+    """
+    Case folds 'value' and strips its accents, so text that matches a case and accent insensitive
+    LIKE also matches after normalization.
+    """
+    decomposed = unicodedata.normalize('NFKD', value)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+def get_trigrams(value):
+    value = normalize_text(value or '')
+    return {value[index:index + 3] for index in range(len(value) - 2)}
+
+
+def build_line_trigrams(feed, batch_size=None):
+    """
+    Replaces the trigrams of the searchable fields of the lines of 'feed' and their frequencies, and
+    marks the feed as indexed. Returns the number of trigrams. The lines are read back from the database since bulk inserts
+    don't return ids on MySQL.
+    """
+    batch_size = batch_size or settings.FEED_INGEST_BATCH_SIZE
+    LineTrigram.objects.filter(feed=feed).delete()
+    TrigramFrequency.objects.filter(feed=feed).delete()
+    queryset = Line.objects.filter(feed=feed).order_by('id').values_list('id', *SEARCH_FIELDS)
+    frequencies = Counter()
+    count = 0
+    last_id = 0
+    while True:
+        # keyset chunks, MySQL client cursors would buffer the whole feed
+        rows = list(queryset.filter(id__gt=last_id)[:batch_size])
+        trigrams = [
+            LineTrigram(feed_id=feed.id, line_id=line_id, field=field, trigram=trigram)
+            for (line_id, *values) in rows
+            for (field, value) in zip(SEARCH_FIELDS.values(), values)
+            for trigram in get_trigrams(value)
+        ]
+        LineTrigram.objects.bulk_create(trigrams, batch_size=batch_size)
+        frequencies.update((trigram.field, trigram.trigram) for trigram in trigrams)
+        count += len(trigrams)
+        if len(rows) < batch_size:
+            break
+
+        last_id = rows[-1][0]
+
+    TrigramFrequency.objects.bulk_create([
+        TrigramFrequency(feed_id=feed.id, field=field, trigram=trigram, lines=lines)
+        for ((field, trigram), lines) in frequencies.items()
+    ], batch_size=batch_size)
+    Feed.objects.filter(id=feed.id).update(search_indexed=True)
+    return count
+
+
+def filter_substring(queryset, name, value, feed_id=None):
+    """
+    Filters 'queryset' to the lines whose field 'name' contains 'value' ignoring case. Within a feed
+    the candidates are the lines having the rarest trigrams of 'value' in that field, then icontains
+    is applied to them so the result is exactly that of icontains. Values shorter than a trigram,
+    trigrams too common to narrow the search down, searches across feeds and feeds not indexed yet
+    use icontains alone.
+    """
+    trigrams = get_trigrams(value)
+    lookup = {f'{name}__icontains': value}
+    if feed_id is None or not trigrams or not Feed.objects.filter(id=feed_id, search_indexed=True).exists():
+        return queryset.filter(**lookup)
+
+    field = SEARCH_FIELDS[name]
+    frequencies = dict(TrigramFrequency.objects
+                       .filter(feed_id=feed_id, field=field, trigram__in=trigrams)
+                       .values_list('trigram', 'lines'))
+    if trigrams - frequencies.keys():
+        # a trigram no line has, no line can contain the value
+        return queryset.none()
+
+    rarest = sorted(trigrams, key=frequencies.get)[:SEARCH_TRIGRAMS]
+    if frequencies[rarest[0]] > settings.SEARCH_MAX_CANDIDATES:
+        return queryset.filter(**lookup)
+
+    candidates = LineTrigram.objects \
+        .filter(feed_id=feed_id, field=field, trigram__in=rarest) \
+        .values('line_id') \
+        .annotate(matches=Count('id')) \
+        .filter(matches=len(rarest)) \
+        .values('line_id')
+    return queryset.filter(id__in=candidates, **lookup)
@@ -1,12 +1,20 @@
 from datetime import timedelta
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from orders.models import Feed, Line, Summary, Planner, Buyer
+from casper.metrics import timed
+from orders import dimensions
+from orders.models import Feed, Line, Summary, Planner, Buyer, IngestionJob
 from users.serializers import UserSerializer
 
 SUPPORTED_EXTENSIONS = {'xls', 'xlsx',}
 
 
+class TimedListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        with timed('serialize'):
+            return super(TimedListSerializer, self).to_representation(data)
+
+
 class FeedSerializer(serializers.ModelSerializer):
     url = serializers.URLField(required=False, write_only=True)
     uploaded_by = serializers.SerializerMethodField()
@@ -23,9 +31,12 @@ class FeedSerializer(serializers.ModelSerializer):
             'buyers',
             'planners',
             'uploaded_by',
+            'checksum',
             'created_at',
             'updated_at',
         )
+        read_only_fields = ('checksum',)
+        list_serializer_class = TimedListSerializer
 
     def to_internal_value(self, data):
         internal_data = super(FeedSerializer, self).to_internal_value(data)
@@ -55,14 +66,10 @@ class FeedSerializer(serializers.ModelSerializer):
         return None
 
     def get_buyers(self, instance):
-        buyers = instance.get_distinct_buyers()
-        serializer = BuyerSerializer(buyers, many=True, context=self.context)
-        return serializer.data
+        return [dimensions.buyers.get_data(buyer.id) for buyer in instance.get_distinct_buyers()]
 
     def get_planners(self, instance):
-        planners = instance.get_distinct_planners()
-        serializer = PlannerSerializer(planners, many=True, context=self.context)
-        return serializer.data
+        return [dimensions.planners.get_data(planner.id) for planner in instance.get_distinct_planners()]
 
 
 class LineSerializer(serializers.ModelSerializer):
@@ -96,19 +103,13 @@ class LineSerializer(serializers.ModelSerializer):
             'created_at',
             'updated_at',
         )
-    def get_buyer(self, instance):
-        if instance.buyer is not None:
-            serializer = BuyerSerializer(instance.buyer, many=False, context=self.context)
-            return serializer.data
+        list_serializer_class = TimedListSerializer
 
-        return None
+    def get_buyer(self, instance):
+        return dimensions.buyers.get_data(instance.buyer_id)
 
     def get_planner(self, instance):
-        if instance.planner is not None:
-            serializer = PlannerSerializer(instance.planner, many=False, context=self.context)
-            return serializer.data
-
-        return None
+        return dimensions.planners.get_data(instance.planner_id)
     
 
 class LineShortSerializer(LineSerializer):
@@ -135,6 +136,7 @@ class LineShortSerializer(LineSerializer):
             'created_at',
             'updated_at',
         )
+        list_serializer_class = TimedListSerializer
 
 
 class PlannerSerializer(serializers.ModelSerializer):
@@ -149,6 +151,47 @@ class BuyerSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class LineRowSerializer:
+    """
+    Serializes lines fetched with values() to the representation of 'serializer_class' without
+    instantiating a serializer per line, buyer and planner come from the dimension caches.
+    """
+    serializer_class = LineShortSerializer
+    related_dimensions = {
+        'buyer': dimensions.buyers,
+        'planner': dimensions.planners,
+    }
+
+    def __init__(self):
+        # (name, values() column, to_representation), related fields are read by id from their cache
+        self.plan = []
+        for (name, field) in self.serializer_class().fields.items():
+            if name in self.related_dimensions:
+                self.plan.append((name, name, self.related_dimensions[name].get_data))
+
+            else:
+                self.plan.append((name, name, field.to_representation))
+
+        self.values_fields = [column for (_, column, _) in self.plan]
+
+    def get_values(self, queryset):
+        # the columns the lines are ordered by are fetched too, keyset pages take their position from the rows
+        ordering = [name.lstrip('-') for name in queryset.query.order_by if isinstance(name, str)]
+        return queryset.values(*self.values_fields, *[name for name in ordering if name not in self.values_fields])
+
+    def to_representation(self, row):
+        data = {}
+        for (name, column, to_representation) in self.plan:
+            value = row[column]
+            data[name] = None if value is None else to_representation(value)
+
+        return data
+
+    def serialize(self, rows):
+        with timed('serialize'):
+            return [self.to_representation(row) for row in rows]
+
+
 class SummarySerializer(serializers.ModelSerializer):
     end_date = serializers.SerializerMethodField()
     buyer = serializers.SerializerMethodField()
@@ -163,6 +206,7 @@ class SummarySerializer(serializers.ModelSerializer):
             'quantity',
             'extended_quantity',
         )
+        list_serializer_class = TimedListSerializer
 
     def get_end_date(self, instance):
         if instance.start_date is not None:
@@ -171,8 +215,28 @@ class SummarySerializer(serializers.ModelSerializer):
         return None
 
     def get_buyer(self, instance):
-        if instance.buyer is not None:
-            serializer = BuyerSerializer(instance.buyer, many=False, context=self.context)
-            return serializer.data
+        return dimensions.buyers.get_data(instance.buyer_id)
 
-        return None
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    elapsed = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestionJob
+        fields = (
+            'id',
+            'feed',
+            'state',
+            'rows_processed',
+            'rows_skipped',
+            'lines_inserted',
+            'summaries_written',
+            'elapsed',
+            'error',
+            'created_at',
+            'started_at',
+            'finished_at',
+        )
+
+    def get_elapsed(self, instance):
+        return instance.get_elapsed()
@@ -1,25 +1,32 @@
+import math
 import pytz
 from datetime import datetime, timedelta
 from dateutil import tz
+from django.conf import settings
+from django.db.models import F
 from django.http.request import QueryDict
 from orders.filters import LineFilter
 
+ORDERS_PAGE_ROWS = 44
+ORDERS_FIELDS = (
+    'id', 'sales_order_number', 'item_number', 'revision', 'quantity', 'extended_quantity', 'unit',
+    'confirmed_shipping', 'purchase_order_number', 'note',
+)
+
 
 def generate_summary_context(feed=None):
     buyers = feed.get_distinct_buyers()
     summary = {}
-    for entry in feed.summary.all():
-        try:
-            summary[entry.start_date]['summary'][entry.buyer.code] = {'quantity': entry.quantity, 'extended_quantity': entry.extended_quantity}
-
-        except KeyError:
-            summary[entry.start_date] = {
-                'start_date': entry.start_date.strftime('%m/%d/%Y'),
-                'end_date': (entry.start_date + timedelta(days=6)).strftime('%m/%d/%Y'),
+    totals = feed.summary.values_list('start_date', 'buyer__code', 'quantity', 'extended_quantity')
+    for (start_date, buyer_code, quantity, extended_quantity) in totals:
+        if start_date not in summary:
+            summary[start_date] = {
+                'start_date': start_date.strftime('%m/%d/%Y'),
+                'end_date': (start_date + timedelta(days=6)).strftime('%m/%d/%Y'),
                 'summary': {buyer.code: {'quantity': 0, 'extended_quantity': 0} for buyer in buyers},
             }
-            summary[entry.start_date]['summary'][entry.buyer.code]['quantity'] = entry.quantity
-            summary[entry.start_date]['summary'][entry.buyer.code]['extended_quantity'] = entry.extended_quantity
+
+        summary[start_date]['summary'][buyer_code] = {'quantity': quantity, 'extended_quantity': extended_quantity}
 
     return {
         'uploaded_by': f'{feed.uploaded_by.first_name} {feed.uploaded_by.last_name}',
@@ -27,10 +34,37 @@ def generate_summary_context(feed=None):
         'summary': summary,
     }
 
-def generate_orders_export(feed=None, query_params={}):
-    lines = LineFilter(QueryDict(query_string=query_params.urlencode()), queryset=feed.lines.all()).qs
-    params = {key: value[0] if len(value) == 1 else value for key, value in query_params.items()}
-    return {
-        'lines': lines,
-        'params': params,
-    }
+def generate_orders_export(feed=None, query_params={}, pages_per_chunk=None):
+    """
+    Yields the contexts of the orders report of the lines of 'feed' matching the LineFilter 'query_params',
+    each one with 'pages_per_chunk' pages of ORDERS_PAGE_ROWS lines numbered across the whole report.
+    """
+    pages_per_chunk = pages_per_chunk or settings.PDF_RENDER_CHUNK_PAGES
+    lines = LineFilter(QueryDict(query_string=query_params.urlencode()), queryset=feed.lines.all(), feed=feed).qs
+    params = {key: value[0] if len(value) == 1 else value for key, value in query_params.lists()}
+    page_count = max(1, math.ceil(lines.count() / ORDERS_PAGE_ROWS))
+    lines = lines.order_by('id').values(*ORDERS_FIELDS, buyer_code=F('buyer__code'), planner_code=F('planner__code'))
+    chunk_rows = pages_per_chunk * ORDERS_PAGE_ROWS
+    last_id = 0
+    page_number = 0
+    while True:
+        rows = list(lines.filter(id__gt=last_id)[:chunk_rows])
+        pages = []
+        for start in range(0, len(rows), ORDERS_PAGE_ROWS):
+            page_number += 1
+            pages.append({'number': page_number, 'lines': rows[start:start + ORDERS_PAGE_ROWS]})
+
+        if page_number == 0:
+            pages.append({'number': 1, 'lines': []})
+
+        if pages:
+            yield {
+                'pages': pages,
+                'page_count': page_count,
+                'params': params,
+            }
+
+        if len(rows) < chunk_rows:
+            break
+
+        last_id = rows[-1]['id']
@@ -1,3 +1,871 @@
-from django.test import TestCase
+import csv
+import io
+from datetime import date, datetime, timedelta
+import json
+import os
+import re
+import weakref
+from concurrent.futures import Future
+from tempfile import NamedTemporaryFile, TemporaryDirectory, TemporaryFile
+from wsgiref.util import setup_testing_defaults
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from openpyxl import Workbook
+from unittest import mock
+from django.core import signals
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from casper.metrics import RequestMetrics, RequestTimings
+from casper.pagination import CasperPagination
+from orders import dimensions
+from orders.diff import diff_feeds, get_field_changes
+from orders.benchmarks import FEED_HEADER, ensure_dimensions, generate_rows, write_feed_xlsx
+from orders.filters import LineFilter
+from orders.ingestion import ingest_rows, rebuild_summaries
+from orders.jobs import claim_next_job, process_job
+from orders.models import Buyer, Feed, IngestionJob, Line, LineTrigram, Summary, TrigramFrequency
+from orders.rendering import PDFRenderer
+from orders.parsing import kit_re, parse_row, read_feed_lines, read_feed_rows
+from orders.search import build_line_trigrams
+from orders.views import FeedView, OrderView, SummaryView, line_row_serializer
+from users.models import User
 
-# Create your tests here.
+
+def create_feed(rows=200, seed=0, uploaded_by=None):
+    feed = Feed.objects.create(file=f'feeds/test-{seed}.xlsx', filename=f'test-{seed}.xlsx', uploaded_by=uploaded_by)
+    ingest_rows(feed, generate_rows(rows, seed=seed))
+    return feed
+
+
+class FeedListTestCase(TestCase):
+    def setUp(self):
+        ensure_dimensions()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_feeds(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/feeds/')
+
+        self.assertEqual(response.status_code, 200)
+        return response.json(), queries
+
+    def test_buyers_and_planners(self):
+        feed = create_feed(uploaded_by=self.user)
+        data, _ = self.get_feeds()
+        lines = feed.lines.all()
+        self.assertEqual(
+            [buyer['code'] for buyer in data['results'][0]['buyers']],
+            sorted(set(lines.values_list('buyer__code', flat=True))),
+        )
+        self.assertEqual(
+            [planner['code'] for planner in data['results'][0]['planners']],
+            sorted(set(lines.values_list('planner__code', flat=True))),
+        )
+
+    def test_constant_query_count(self):
+        for seed in range(5):
+            create_feed(seed=seed, uploaded_by=self.user)
+
+        # count, feeds joined with their uploaders, buyers, planners and pending requests of admin uploaders
+        with self.assertNumQueries(5):
+            data, queries = self.get_feeds()
+
+        self.assertEqual(data['count'], 5)
+        for query in queries:
+            self.assertNotIn(Line._meta.db_table, query['sql'])
+
+
+def make_row(sales_order_number, item_number, quantity, confirmed_shipping, buyer_code, planner_code=None,
+             site='104-CA'):
+    # the other columns of a generated row
+    row = list(next(generate_rows(1, skip_ratio=0)))
+    row[0], row[2], row[5], row[9] = sales_order_number, item_number, float(quantity), confirmed_shipping
+    row[11], row[18], row[19] = site, buyer_code, planner_code
+    return row
+
+
+class IngestionTestCase(TestCase):
+    def setUp(self):
+        ensure_dimensions()
+        self.feed = Feed.objects.create(file='feeds/known.xlsx', filename='known.xlsx')
+
+    def test_known_output(self):
+        rows = [
+            make_row('S1', 'EZC6A24Q12-01', 10, datetime(2021, 7, 5), 'ORT', 'P01'),
+            make_row('S1', 'SS-10001-1', 5, datetime(2021, 7, 11), 'ORT'),
+            # kit items only count their kits for ORT
+            make_row('S2', 'EZC6A24Q12-01', 3, datetime(2021, 7, 12), 'ABC', 'P02'),
+            make_row('S2', 'SS-10002-2', 7, datetime(2021, 7, 20), 'ABC', 'P02'),
+            make_row('S3', 'SS-10003-3', 4, datetime(2021, 7, 6), 'ABC', 'P03'),
+            make_row('S4', 'SS-10004-4', 9, datetime(2021, 7, 6), 'ABC', site='105-MX'),
+            make_row('S5', 'SS-10005-5', 9, None, 'ABC'),
+            make_row('S6', 'EZRD6100Q100-01', 2, datetime(2021, 7, 13), 'ORT', 'P01'),
+        ]
+        # batches split the lines of a week and buyer
+        stats = ingest_rows(self.feed, rows, batch_size=4)
+        self.assertEqual(
+            (stats['rows_processed'], stats['rows_skipped'], stats['lines'], stats['summaries']), (8, 2, 6, 5),
+        )
+        lines = self.feed.lines.order_by('id').values_list(
+            'sales_order_number', 'quantity', 'extended_quantity', 'confirmed_shipping', 'buyer__code', 'planner__code',
+        )
+        self.assertEqual(list(lines), [
+            ('S1', 10, 120, date(2021, 7, 5), 'ORT', 'P01'),
+            # without a planner, the planner named after the buyer
+            ('S1', 5, 5, date(2021, 7, 11), 'ORT', 'ORT'),
+            ('S2', 3, 3, date(2021, 7, 12), 'ABC', 'P02'),
+            ('S2', 7, 7, date(2021, 7, 20), 'ABC', 'P02'),
+            ('S3', 4, 4, date(2021, 7, 6), 'ABC', 'P03'),
+            ('S6', 2, 200, date(2021, 7, 13), 'ORT', 'P01'),
+        ])
+        summaries = Summary.objects.filter(feed=self.feed).values_list(
+            'start_date', 'buyer__code', 'quantity', 'extended_quantity',
+        )
+        # weeks start on Monday
+        self.assertEqual(sorted(summaries), [
+            (date(2021, 7, 5), 'ABC', 4, 4),
+            (date(2021, 7, 5), 'ORT', 15, 125),
+            (date(2021, 7, 12), 'ABC', 3, 3),
+            (date(2021, 7, 12), 'ORT', 2, 200),
+            (date(2021, 7, 19), 'ABC', 7, 7),
+        ])
+        self.assertEqual(set(self.feed.buyers.values_list('code', flat=True)), {'ABC', 'ORT'})
+        self.assertEqual(set(self.feed.planners.values_list('code', flat=True)), {'ORT', 'P01', 'P02', 'P03'})
+
+    def get_summaries(self):
+        summaries = Summary.objects.filter(feed=self.feed).values_list(
+            'start_date', 'buyer_id', 'quantity', 'extended_quantity',
+        )
+        return {(start_date, buyer_id): totals for (start_date, buyer_id, *totals) in summaries}
+
+    def get_per_line_summaries(self):
+        # the totals the upload used to add up line by line
+        summaries = {}
+        lines = self.feed.lines.values_list('confirmed_shipping', 'buyer_id', 'quantity', 'extended_quantity')
+        for (confirmed_shipping, buyer_id, quantity, extended_quantity) in lines:
+            key = (confirmed_shipping - timedelta(days=confirmed_shipping.weekday()), buyer_id)
+            totals = summaries.get(key, [0, 0])
+            summaries[key] = [totals[0] + quantity, totals[1] + extended_quantity]
+
+        return summaries
+
+    def test_rebuild_summaries(self):
+        ingest_rows(self.feed, generate_rows(300, seed=5))
+        expected = self.get_per_line_summaries()
+        self.assertEqual(self.get_summaries(), expected)
+
+        line = self.feed.lines.order_by('id').first()
+        Line.objects.filter(id=line.id).update(
+            confirmed_shipping=line.confirmed_shipping + timedelta(days=21), quantity=F('quantity') + 1,
+        )
+        version = Feed.objects.get(id=self.feed.id).version
+        self.assertEqual(rebuild_summaries(self.feed), len(self.get_per_line_summaries()))
+        self.assertEqual(self.get_summaries(), self.get_per_line_summaries())
+        self.assertNotEqual(self.get_summaries(), expected)
+        self.assertGreater(Feed.objects.get(id=self.feed.id).version, version)
+
+
+class FeedFileTestCase(TestCase):
+    def test_generated_feed(self):
+        rows = list(generate_rows(300, seed=1))
+        with TemporaryFile() as dst:
+            write_feed_xlsx(rows, dst)
+            dst.seek(0)
+            stored = list(read_feed_rows(dst))
+
+        self.assertEqual(stored[0], FEED_HEADER)
+        self.assertEqual(len(stored), len(rows) + 1)
+        self.assertIsNone(parse_row(stored[0]))
+        lines = [values for values in map(parse_row, stored[1:]) if values is not None]
+        self.assertEqual(len(lines), len([row for row in rows if parse_row(row) is not None]))
+        kits = [values for values in lines if values['buyer_code'] == 'ORT' and kit_re.match(values['item_number'])]
+        self.assertTrue(kits)
+        for values in kits:
+            self.assertEqual(values['extended_quantity'],
+                             values['quantity'] * int(kit_re.match(values['item_number']).group(1)))
+
+    @override_settings(FEED_PARSE_CHUNK_ROWS=16)
+    def test_parallel_parsing(self):
+        wb = Workbook()
+        ws = wb.active
+        ws.append(FEED_HEADER)
+        # rows missing from the worksheet, within a chunk and whole chunks, must be kept in place
+        for (index, row) in enumerate(generate_rows(200, seed=2)):
+            if index % 7 != 5 and not 40 <= index < 75:
+                for (column, value) in enumerate(row, start=1):
+                    ws.cell(row=index + 2, column=column, value=value)
+
+        with NamedTemporaryFile(suffix='.xlsx') as dst:
+            wb.save(dst.name)
+            expected = list(map(parse_row, read_feed_rows(dst.name)))
+            self.assertEqual(len(expected), 201)
+            for workers in (2, 3):
+                self.assertEqual(list(read_feed_lines(dst.name, workers=workers)), expected)
+
+
+class SearchTestCase(TestCase):
+    searches = (
+        ('note', ('material', 'MATERIAL', 'MaTeRiAl', 'ship', 'Café', 'cafe', 'CAFÉ', 'é', 'Ré', 'ex', 'p', 'zzz')),
+        ('customer_reference', ('REF-1', 'ref-12', 'Ñu', 'ñ', '99', '9')),
+        ('item_number', ('ss-1', '4Q12', 'ezc', '7', 'Über')),
+    )
+
+    def setUp(self):
+        ensure_dimensions()
+        self.feed = create_feed(rows=400, seed=5)
+        # accents and mixed case the generated rows don't have
+        lines = list(self.feed.lines.order_by('id').values_list('id', flat=True))
+        for (index, (note, reference, item_number)) in enumerate((
+                ('Café au lait', 'Ñuñoa 12', 'ÜBER-77'),
+                ('CAFÉ NOIR', 'ñu', 'über-1'),
+                ('cafe', 'REF-ñ', 'Uber-9'),
+                ('Réunion', None, 'SS-REF'),
+                (None, 'ref-99', 'ss-1'))):
+            Line.objects.filter(id=lines[index]).update(note=note, customer_reference=reference, item_number=item_number)
+
+        build_line_trigrams(self.feed)
+
+    def get_ids(self, name, term, feed=None):
+        queryset = Line.objects.filter(feed=self.feed).order_by('id')
+        return list(LineFilter({name: term}, queryset=queryset, feed=feed).qs.values_list('id', flat=True))
+
+    def assert_same_as_icontains(self):
+        for (name, terms) in self.searches:
+            for term in terms:
+                with self.subTest(name=name, term=term):
+                    self.assertEqual(self.get_ids(name, term, feed=self.feed), self.get_ids(name, term))
+
+    def test_indexed_search(self):
+        self.assertTrue(Feed.objects.get(id=self.feed.id).search_indexed)
+        self.assertTrue(self.get_ids('note', 'material', feed=self.feed))
+        self.assert_same_as_icontains()
+
+    def test_feed_without_index(self):
+        # feeds ingested before the index existed
+        LineTrigram.objects.filter(feed=self.feed).delete()
+        TrigramFrequency.objects.filter(feed=self.feed).delete()
+        Feed.objects.filter(id=self.feed.id).update(search_indexed=False)
+        self.assertTrue(self.get_ids('note', 'material', feed=self.feed))
+        self.assert_same_as_icontains()
+
+
+class ServerTestCase(TestCase):
+    """
+    Drives the applications the production servers load, not the test client.
+    """
+
+    def setUp(self):
+        ensure_dimensions()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True,
+                                        is_active=True)
+        self.feed = create_feed(rows=300, uploaded_by=self.user)
+        # like the test client, the connection of the test transaction must outlive the requests
+        signals.request_started.disconnect(close_old_connections)
+        signals.request_finished.disconnect(close_old_connections)
+
+    def tearDown(self):
+        signals.request_started.connect(close_old_connections)
+        signals.request_finished.connect(close_old_connections)
+
+    def get(self, path, query=''):
+        from casper.wsgi import application
+
+        environ = {
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'HTTP_HOST': 'testserver',
+            'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}',
+        }
+        setup_testing_defaults(environ)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split()[0])
+
+        result = application(environ, start_response)
+        try:
+            content = b''.join(result)
+
+        finally:
+            result.close()
+
+        return started['status'], content
+
+    def test_streamed_responses(self):
+        lines = self.feed.lines.count()
+        status, content = self.get(f'/feeds/{self.feed.id}/orders/', 'pagination=0')
+        self.assertEqual(status, 200, content)
+        data = json.loads(content)
+        self.assertEqual(data['count'], lines)
+        self.assertEqual(len(data['results']), lines)
+        status, content = self.get(f'/feeds/{self.feed.id}/orders/export.csv/')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(list(csv.reader(io.StringIO(content.decode('utf-8'))))), lines + 1)
+
+    def test_events_application_only_serves_events(self):
+        from casper.asgi import application
+
+        async def get_start():
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http', 'method': 'GET', 'path': f'/feeds/{self.feed.id}/orders/', 'query_string': b'', 'headers': [],
+            })
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output(1)
+            await communicator.wait(1)
+            return start
+
+        self.assertEqual(async_to_sync(get_start)()['status'], 404)
+
+
+class ConditionalTestCase(TestCase):
+    def setUp(self):
+        ensure_dimensions()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.feed = create_feed(uploaded_by=self.user)
+        self.url = f'/feeds/{self.feed.id}/orders/?limit=20'
+
+    @override_settings(DIMENSION_CACHE_CHECK_INTERVAL=3600)
+    def test_not_modified(self):
+        for cache in (dimensions.buyers, dimensions.planners):
+            cache.get_state(refresh=True)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # only the version of the feed is read, no queryset or serializer runs
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_dimension_change(self):
+        etag = self.client.get(self.url)['ETag']
+        buyer = Buyer.objects.filter(id__in=self.feed.lines.values('buyer_id')).first()
+        buyer.name = 'Renamed'
+        buyer.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        ensure_dimensions()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.feed = create_feed(uploaded_by=self.user)
+        self.url = f'/feeds/{self.feed.id}/orders/'
+
+    def get_expected_ids(self, order_by):
+        # NULL sorts as the smallest value, ties are broken by id
+        name = order_by.lstrip('-')
+        if order_by.startswith('-'):
+            ordering = F(name).desc(nulls_last=True)
+
+        else:
+            ordering = F(name).asc(nulls_first=True)
+
+        return list(self.feed.lines.order_by(ordering, 'id').values_list('id', flat=True))
+
+    def walk(self, order_by, limit):
+        ids = []
+        url = f'{self.url}?pagination=cursor&order_by={order_by}&limit={limit}'
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            data = response.json()
+            self.assertIsNone(data['previous'])
+            self.assertLessEqual(len(data['results']), limit)
+            ids.extend(line['id'] for line in data['results'])
+            url = data['next']
+
+        return ids
+
+    def test_cursor_walk(self):
+        for order_by in ('-note', 'note', '-buyer__code', 'planner__code', '-confirmed_shipping'):
+            with self.subTest(order_by=order_by):
+                self.assertEqual(self.walk(order_by, 7), self.get_expected_ids(order_by))
+
+    def test_streamed_results(self):
+        # small chunks, so the results are joined across several keyset queries
+        with mock.patch.object(CasperPagination, 'stream_chunk_size', 7):
+            response = self.client.get(self.url, {'pagination': '0', 'order_by': '-note'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            data = json.loads(b''.join(response.streaming_content))
+            self.assertEqual(list(data), ['next', 'previous', 'results', 'count'])
+            self.assertIsNone(data['next'])
+            self.assertIsNone(data['previous'])
+            self.assertEqual(data['count'], self.feed.lines.count())
+            self.assertEqual([line['id'] for line in data['results']], self.get_expected_ids('-note'))
+
+            response = self.client.get(self.url, {'pagination': '0', 'id': '0'})
+            data = json.loads(b''.join(response.streaming_content))
+            self.assertEqual(data, {'next': None, 'previous': None, 'results': [], 'count': 0})
+
+
+class DiffTestCase(TestCase):
+    def setUp(self):
+        ensure_dimensions()
+        self.rows = [list(row) for row in generate_rows(60, seed=3, skip_ratio=0)]
+
+    def create_feed(self, rows, name):
+        feed = Feed.objects.create(file=f'feeds/{name}.xlsx', filename=f'{name}.xlsx', ingested=True)
+        ingest_rows(feed, rows)
+        # without skipped rows, lines are created in the order of the rows
+        return feed, list(feed.lines.order_by('id').values_list('id', flat=True))
+
+    def with_values(self, row, quantity=None, confirmed_shipping=None, note=None):
+        row = list(row)
+        if quantity is not None:
+            row[5] = float(quantity)
+
+        if confirmed_shipping is not None:
+            row[9] = confirmed_shipping
+
+        if note is not None:
+            row[10] = note
+
+        return row
+
+    def test_diff_feeds(self):
+        rows = self.rows
+        shipping = rows[8][9] + timedelta(days=10)
+        # copies of rows 40 and 50 share their keys, row 10 is dropped and row 59 is new
+        previous_rows = rows[:40] + [
+            self.with_values(rows[40], quantity=1),
+            self.with_values(rows[40], quantity=2),
+            self.with_values(rows[50], quantity=1),
+            self.with_values(rows[50], quantity=2),
+        ]
+        current_rows = (
+            rows[:5]
+            + [self.with_values(rows[5], quantity=rows[5][5] + 1)]
+            + rows[6:8]
+            + [self.with_values(rows[8], confirmed_shipping=shipping, note='Moved')]
+            + rows[9:10] + rows[11:40]
+            + [
+                self.with_values(rows[40], quantity=1),
+                self.with_values(rows[40], quantity=3),
+                self.with_values(rows[40], quantity=4),
+                self.with_values(rows[50], quantity=1),
+                rows[59],
+            ]
+        )
+        previous, previous_ids = self.create_feed(previous_rows, 'previous')
+        current, current_ids = self.create_feed(current_rows, 'current')
+        result = diff_feeds(current, previous)
+        # the third line of the key of row 40 and row 59
+        self.assertEqual(sorted(result['added']), [current_ids[41], current_ids[43]])
+        # row 10 and the second line of the key of row 50
+        self.assertEqual(sorted(result['removed']), [previous_ids[10], previous_ids[43]])
+        self.assertEqual(sorted(result['changed']), [
+            (previous_ids[5], current_ids[5]),
+            (previous_ids[8], current_ids[8]),
+            # the second lines of the key of row 40
+            (previous_ids[41], current_ids[40]),
+        ])
+        self.assertEqual(result['unchanged'], 40 - 3 + 2)
+
+        changes = {change['id']: change for change in get_field_changes(result['changed'])}
+        self.assertEqual(changes[current_ids[5]]['previous_id'], previous_ids[5])
+        self.assertEqual(changes[current_ids[5]]['changes'], {'quantity': {'from': int(rows[5][5]), 'to': int(rows[5][5]) + 1}})
+        self.assertEqual(changes[current_ids[8]]['item_number'], rows[8][2])
+        self.assertEqual(changes[current_ids[8]]['changes'], {
+            'confirmed_shipping': {'from': rows[8][9].date(), 'to': shipping.date()},
+            'note': {'from': rows[8][10], 'to': 'Moved'},
+        })
+        self.assertEqual(changes[current_ids[40]]['changes'], {'quantity': {'from': 2, 'to': 3}})
+
+    def test_diff_view(self):
+        user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        rows = self.rows
+        previous, previous_ids = self.create_feed(rows[:50], 'previous')
+        current, current_ids = self.create_feed(
+            rows[:5] + [self.with_values(rows[5], note='Moved')] + rows[6:20] + rows[21:50] + rows[50:53], 'current',
+        )
+        url = f'/feeds/{current.id}/diff/{previous.id}/'
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'feed': current.id,
+            'other': previous.id,
+            'summary': {'added': 3, 'removed': 1, 'changed': 1, 'unchanged': 48},
+        })
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        data = client.get(url, {'detail': 'added', 'limit': 2}).json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([line['id'] for line in data['results']], current_ids[-3:-1])
+        self.assertEqual(data['results'][0]['item_number'], rows[50][2])
+        data = client.get(data['next']).json()
+        self.assertEqual([line['id'] for line in data['results']], current_ids[-1:])
+
+        data = client.get(url, {'detail': 'removed'}).json()
+        self.assertEqual([line['id'] for line in data['results']], [previous_ids[20]])
+        data = client.get(url, {'detail': 'changed'}).json()
+        self.assertEqual(data['summary']['changed'], 1)
+        self.assertEqual(data['results'][0]['previous_id'], previous_ids[5])
+        self.assertEqual(data['results'][0]['changes']['note']['to'], 'Moved')
+
+        self.assertEqual(client.get(url, {'detail': 'unchanged'}).status_code, 400)
+        self.assertEqual(client.get(url, {'detail': 'added', 'pagination': 'cursor'}).status_code, 400)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@belf.com', first_name='Test', last_name='Admin', is_admin=True)
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner')
+        self.client = APIClient()
+
+    def get_status(self, user=None, token=None):
+        self.client.force_authenticate(user)
+        if token is not None:
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        else:
+            self.client.credentials()
+
+        return self.client.get('/metrics').status_code
+
+    @override_settings(ENVIRONMENT='development', METRICS_TOKEN=None)
+    def test_development(self):
+        self.assertEqual(self.get_status(), 200)
+
+    @override_settings(ENVIRONMENT='production', METRICS_TOKEN=None)
+    def test_production_without_token(self):
+        self.assertEqual(self.get_status(), 401)
+        self.assertEqual(self.get_status(self.user), 403)
+        self.assertEqual(self.get_status(self.admin), 200)
+
+    @override_settings(ENVIRONMENT='production', METRICS_TOKEN='scraper-token')
+    def test_production_with_token(self):
+        self.assertEqual(self.get_status(token='scraper-token'), 200)
+        # rejected by the JWT authentication, like any invalid token on the API
+        self.assertEqual(self.get_status(token='other-token'), 403)
+        self.assertEqual(self.get_status(), 401)
+        self.assertEqual(self.get_status(self.user), 403)
+        self.assertEqual(self.get_status(self.admin), 200)
+
+
+    def observe(self, metrics, view, status, total):
+        timings = RequestTimings()
+        timings.db_queries = 2
+        metrics.observe(view, 'GET', status, timings, total)
+
+    def test_merge(self):
+        first, second = RequestMetrics(), RequestMetrics()
+        self.observe(first, 'feeds-list', 200, 0.02)
+        self.observe(second, 'feeds-list', 200, 0.3)
+        self.observe(second, 'feeds-list', 500, 0.3)
+        self.observe(second, 'health', 200, 0.001)
+        merged = RequestMetrics()
+        merged.merge(first.get_snapshot())
+        merged.merge(second.get_snapshot())
+        content = merged.export()
+        labels = 'view="feeds-list",method="GET"'
+        self.assertIn(f'casper_request_duration_seconds_bucket{{{labels},le="0.025"}} 1\n', content)
+        self.assertIn(f'casper_request_duration_seconds_bucket{{{labels},le="0.5"}} 3\n', content)
+        self.assertIn(f'casper_request_duration_seconds_count{{{labels}}} 3\n', content)
+        self.assertIn(f'casper_requests_total{{{labels},status="2xx"}} 2\n', content)
+        self.assertIn(f'casper_requests_total{{{labels},status="5xx"}} 1\n', content)
+        self.assertIn(f'casper_request_db_queries_total{{{labels}}} 6\n', content)
+        self.assertIn('casper_request_duration_seconds_count{view="health",method="GET"} 1\n', content)
+
+    @override_settings(ENVIRONMENT='development', METRICS_TOKEN=None)
+    def test_processes_merged(self):
+        other = RequestMetrics()
+        for _ in range(3):
+            self.observe(other, 'other-view', 200, 0.1)
+
+        with TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            # written by another worker of the server
+            with open(f'{directory}/1-other.json', 'w') as f:
+                json.dump({'requests': other.get_snapshot(), 'renderer': {'completed': 4, 'in_flight': 1}}, f)
+
+            content = self.client.get('/metrics').content.decode('utf-8')
+
+        self.assertIn('casper_request_duration_seconds_count{view="other-view",method="GET"} 3\n', content)
+        completed = int(re.search(r'casper_pdf_render_completed_total (\d+)\n', content).group(1))
+        self.assertGreaterEqual(completed, 4)
+
+
+class RenderingTestCase(TestCase):
+    def test_chunk_futures_are_dropped(self):
+        renderer = PDFRenderer(workers=2, max_queue=0, timeout=5)
+        futures = []
+
+        def submit(content):
+            future = Future()
+            future.set_result((content.encode('utf-8'), 0.0, 0.0))
+            futures.append(weakref.ref(future))
+            return future
+
+        def merge_pdfs(parts, dst):
+            # every chunk is spooled by now, none of their PDFs is left in memory
+            self.assertEqual([future for future in futures if future() is not None], [])
+            self.assertEqual(len(parts), 50)
+            for part in parts:
+                dst.write(part.read())
+
+        dst = io.BytesIO()
+        with mock.patch.object(renderer, 'submit', submit), \
+                mock.patch('orders.rendering.render_to_string', lambda template, context: f'{context["index"]};'), \
+                mock.patch('orders.rendering.merge_pdfs', merge_pdfs):
+            renderer.render_chunks('reports/orders.html', ({'index': index} for index in range(50)), dst, 2)
+
+        self.assertEqual(dst.getvalue().decode('utf-8'), ''.join(f'{index};' for index in range(50)))
+        self.assertEqual(renderer.get_metrics()['in_flight'], 0)
+        self.assertEqual(renderer.get_metrics()['completed'], 50)
+
+
+class PivotTestCase(TestCase):
+    def setUp(self):
+        ensure_dimensions()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.feed = create_feed(uploaded_by=self.user)
+
+    def get_pivot(self):
+        response = self.client.get(f'/feeds/{self.feed.id}/pivot/', {'rows': 'buyer', 'cols': 'planner'})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_renamed_buyer(self):
+        pivot = self.get_pivot()
+        buyer = Buyer.objects.filter(id__in=self.feed.lines.values('buyer_id')).order_by('code').first()
+        code = buyer.code
+        self.assertIn(code, pivot['row_keys'])
+        buyer.code = 'ZZZ'
+        buyer.save()
+
+        pivot = self.get_pivot()
+        self.assertNotIn(code, pivot['row_keys'])
+        self.assertEqual(pivot['row_keys'][-1], 'ZZZ')
+        self.assertEqual(pivot['row_totals'][-1], sum(self.feed.lines.filter(buyer=buyer).values_list('extended_quantity', flat=True)))
+
+    def test_missing_dimension(self):
+        self.assertEqual(dimensions.get_code(dimensions.buyers, 0), '#0')
+
+
+class IngestionJobTestCase(TestCase):
+    databases = {'default', 'progress'}
+
+    def create_job(self, name, **kwargs):
+        feed = Feed.objects.create(file=f'feeds/{name}.xlsx', filename=f'{name}.xlsx')
+        return IngestionJob.objects.create(feed=feed, **kwargs)
+
+    def test_claim_abandoned_jobs(self):
+        now = timezone.now()
+        long_ago = now - timedelta(hours=1)
+        pending = self.create_job('pending')
+        abandoned = self.create_job('abandoned', state=IngestionJob.RUNNING, started_at=long_ago, heartbeat_at=long_ago)
+        without_heartbeat = self.create_job('without-heartbeat', state=IngestionJob.RUNNING, started_at=long_ago)
+        self.create_job('running', state=IngestionJob.RUNNING, started_at=long_ago, heartbeat_at=now)
+        self.create_job('done', state=IngestionJob.DONE, started_at=long_ago, heartbeat_at=long_ago)
+        claimed = {claim_next_job(), claim_next_job(), claim_next_job()}
+        self.assertEqual(claimed, {pending.id, abandoned.id, without_heartbeat.id})
+        self.assertIsNone(claim_next_job())
+        abandoned.refresh_from_db()
+        self.assertEqual(abandoned.state, IngestionJob.RUNNING)
+        self.assertGreater(abandoned.heartbeat_at, now)
+
+
+class TemporaryMediaMixin:
+    """
+    Stores the files written by the test in a temporary MEDIA_ROOT removed afterwards.
+    """
+
+    def setUp(self):
+        super(TemporaryMediaMixin, self).setUp()
+        self.media_root = TemporaryDirectory()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        self.media_root.cleanup()
+        super(TemporaryMediaMixin, self).tearDown()
+
+    def get_stored_files(self, directory):
+        path = os.path.join(self.media_root.name, directory)
+        return sorted(os.path.join(root, name) for (root, _, names) in os.walk(path) for name in names)
+
+
+@override_settings(FEED_INGEST_WORKERS=0)
+class FeedUploadTestCase(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super(FeedUploadTestCase, self).setUp()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        with TemporaryFile() as dst:
+            write_feed_xlsx(generate_rows(50, seed=4), dst)
+            dst.seek(0)
+            self.content = dst.read()
+
+    def upload(self):
+        src = SimpleUploadedFile('feed.xlsx', self.content, content_type='application/octet-stream')
+        return self.client.post('/feeds/upload/', {'file': src}, format='multipart')
+
+    def test_duplicate_upload(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 202)
+        duplicate = self.upload()
+        self.assertEqual(duplicate.status_code, 200)
+        self.assertEqual(duplicate.data['id'], response.data['id'])
+        self.assertEqual(Feed.objects.count(), 1)
+
+    def test_concurrent_upload(self):
+        response = self.upload()
+        get_duplicate_job = FeedView.get_duplicate_job
+        calls = []
+
+        def get_duplicate_job_after_check(view, checksum):
+            # the other upload commits between the duplicate check and the insert
+            calls.append(checksum)
+            return None if len(calls) == 1 else get_duplicate_job(view, checksum)
+
+        with mock.patch.object(FeedView, 'get_duplicate_job', get_duplicate_job_after_check):
+            duplicate = self.upload()
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(duplicate.status_code, 200)
+        self.assertEqual(duplicate.data['id'], response.data['id'])
+        self.assertEqual(Feed.objects.count(), 1)
+        # the file stored by the losing upload is removed
+        self.assertEqual(self.get_stored_files('feeds'), [Feed.objects.get().file.path])
+
+    def test_upload_after_failure(self):
+        response = self.upload()
+        # what process_job leaves behind when the ingestion fails
+        Feed.objects.update(checksum=None)
+        IngestionJob.objects.update(state=IngestionJob.FAILED, error='Broken')
+        retry = self.upload()
+        self.assertEqual(retry.status_code, 202)
+        self.assertNotEqual(retry.data['id'], response.data['id'])
+        self.assertEqual(retry.data['state'], IngestionJob.PENDING)
+
+    def test_upload_of_abandoned_job(self):
+        response = self.upload()
+        long_ago = timezone.now() - timedelta(hours=1)
+        IngestionJob.objects.update(state=IngestionJob.RUNNING, started_at=long_ago, heartbeat_at=long_ago)
+        retry = self.upload()
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry.data['id'], response.data['id'])
+        self.assertEqual(retry.data['state'], IngestionJob.PENDING)
+        self.assertEqual(Feed.objects.count(), 1)
+
+
+class IngestionJobProcessTestCase(TemporaryMediaMixin, TransactionTestCase):
+    # progress is written on its own connection, the job must be committed
+    databases = {'default', 'progress'}
+
+    def test_process_left_behind_job(self):
+        ensure_dimensions()
+        with NamedTemporaryFile(suffix='.xlsx') as dst:
+            write_feed_xlsx(generate_rows(200, seed=3), dst)
+            dst.flush()
+            user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner')
+            feed = Feed.objects.create(file=dst.name, filename='left-behind.xlsx', uploaded_by=user)
+            job = IngestionJob.objects.create(feed=feed)
+            self.assertEqual(claim_next_job(), job.id)
+            process_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.state, IngestionJob.DONE)
+        self.assertEqual(job.rows_processed, 201)
+        self.assertEqual(feed.lines.count(), job.lines_inserted)
+        # the summary export prewarmed for the uploader
+        feed.refresh_from_db()
+        self.assertEqual(self.get_stored_files('summaries'), [feed.summary_file.path])
+
+
+def get_full_scans(queryset, table):
+    """
+    Returns the steps of the query plan of 'queryset' that read every row of 'table'.
+    """
+    if connection.vendor == 'mysql':
+        scans = []
+
+        def walk(node):
+            if isinstance(node, dict):
+                if node.get('table_name') == table and node.get('access_type') == 'ALL':
+                    scans.append(node)
+
+                for value in node.values():
+                    walk(value)
+
+            elif isinstance(node, list):
+                for value in node:
+                    walk(value)
+
+        walk(json.loads(queryset.explain(format='json')))
+        return scans
+
+    # sqlite, "SEARCH" steps use an index to find the rows, "SCAN" steps read them all
+    return [step for step in queryset.explain().splitlines() if re.search(rf'\bSCAN (TABLE )?{table}\b', step)]
+
+
+class QueryPlanTestCase(TestCase):
+    filters = (
+        {},
+        {'confirmed_shipping_gte': '1625097600'},
+        {'confirmed_shipping_gte': '1625097600', 'confirmed_shipping_lt': '1633046400'},
+        {'sales_order_number': '1000001,1000002'},
+        {'purchase_order_number': 'PO-100000,PO-200000'},
+        {'buyer': 'ORT,ABC'},
+        {'planner': 'P01'},
+        {'item_number': 'SS-'},
+        {'note': 'material'},
+        {'buyer': 'ORT', 'confirmed_shipping_lte': '1633046400'},
+    )
+
+    def setUp(self):
+        ensure_dimensions()
+        self.user = User.objects.create(email='planner@belf.com', first_name='Test', last_name='Planner', is_admin=True)
+        self.feeds = [create_feed(rows=300, seed=seed) for seed in range(4)]
+        if connection.vendor == 'mysql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE TABLE {Line._meta.db_table}, {Summary._meta.db_table}')
+
+    def get_queryset(self, view_class, params):
+        request = APIRequestFactory().get(f'/feeds/{self.feeds[0].id}/', params)
+        request.user = self.user
+        view = view_class(action='list', kwargs={'feed_pk': self.feeds[0].id}, format_kwarg=None)
+        view.request = Request(request)
+        return view.filter_queryset(view.get_queryset())
+
+    def assertNoFullScan(self, queryset, table):
+        self.assertEqual(get_full_scans(queryset, table), [], str(queryset.query))
+
+    def test_line_filters(self):
+        for params in self.filters:
+            for ordering in (None,) + OrderView.ordering_fields:
+                query_params = dict(params, order_by=ordering) if ordering else params
+                with self.subTest(params=query_params):
+                    queryset = line_row_serializer.get_values(self.get_queryset(OrderView, query_params))
+                    self.assertNoFullScan(queryset[:100], Line._meta.db_table)
+
+    def test_summary(self):
+        self.assertNoFullScan(self.get_queryset(SummaryView, {}), Summary._meta.db_table)
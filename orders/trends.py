@@ -0,0 +1,88 @@
+from django.db.models import Sum
+from django.utils import dateparse
+from orders import dimensions
+from orders.models import Feed, WeeklyRollup
+
+TREND_MEASURES = ('quantity', 'extended_quantity', 'net_amount', 'lines')
+TREND_DEFAULT_FEEDS = 20
+TREND_MAX_FEEDS = 100
+
+
+class InvalidTrend(ValueError):
+    pass
+
+
+def get_date_param(query_params, name):
+    value = query_params.get(name)
+    if not value:
+        return None
+
+    try:
+        parsed = dateparse.parse_date(value)
+
+    except ValueError:
+        parsed = None
+
+    if parsed is None:
+        raise InvalidTrend(f'{name} must be a date formatted as YYYY-MM-DD.')
+
+    return parsed
+
+
+def get_dimension_ids(cache, value):
+    # unknown codes select nothing
+    ids = []
+    for code in value.split(','):
+        try:
+            ids.append(cache.get_by_code(code.strip()).id)
+
+        except KeyError:
+            pass
+
+    return ids
+
+
+def get_trend(query_params):
+    """
+    Returns the weekly totals of 'measure' in each of the last 'feeds' ingested feeds, oldest first, for the
+    weeks starting between 'start' and 'end' and the comma separated 'buyer' and 'planner' codes. The
+    totals come from the weekly rollups with one GROUP BY, weeks a feed has no lines for are 0.
+    Raises InvalidTrend for invalid parameters.
+    """
+    measure = query_params.get('measure') or 'extended_quantity'
+    if measure not in TREND_MEASURES:
+        raise InvalidTrend(f'measure must be one of: {", ".join(TREND_MEASURES)}.')
+
+    try:
+        count = int(query_params.get('feeds') or TREND_DEFAULT_FEEDS)
+
+    except ValueError:
+        raise InvalidTrend('feeds must be a number.')
+
+    count = max(1, min(count, TREND_MAX_FEEDS))
+    start = get_date_param(query_params, 'start')
+    end = get_date_param(query_params, 'end')
+    feeds = list(Feed.objects.filter(ingested=True).order_by('-id').values('id', 'filename', 'created_at')[:count])
+    feeds.reverse()
+    queryset = WeeklyRollup.objects.filter(feed_id__in=[feed['id'] for feed in feeds])
+    if start is not None:
+        queryset = queryset.filter(start_date__gte=start)
+
+    if end is not None:
+        queryset = queryset.filter(start_date__lte=end)
+
+    if query_params.get('buyer'):
+        queryset = queryset.filter(buyer_id__in=get_dimension_ids(dimensions.buyers, query_params['buyer']))
+
+    if query_params.get('planner'):
+        queryset = queryset.filter(planner_id__in=get_dimension_ids(dimensions.planners, query_params['planner']))
+
+    totals = queryset.order_by().values('start_date', 'feed_id').annotate(value=Sum(measure))
+    cells = {(total['start_date'], total['feed_id']): total['value'] for total in totals}
+    weeks = sorted({week for (week, _) in cells})
+    return {
+        'measure': measure,
+        'feeds': feeds,
+        'weeks': weeks,
+        'values': [[cells.get((week, feed['id']), 0) for feed in feeds] for week in weeks],
+    }
@@ -1,11 +1,10 @@
-import re
+import os
 from base64 import b64encode
-from datetime import datetime, timedelta
-from decimal import Decimal
+from tempfile import TemporaryFile
 from easy_pdf.rendering import render_to_pdf
-from openpyxl import load_workbook
 from openpyxl.utils.exceptions import InvalidFileException
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.http import FileResponse, StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from django.shortcuts import get_object_or_404
 from django.utils import dateparse
@@ -13,13 +12,30 @@ from rest_framework import mixins, viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from orders.models import Line, Buyer, Planner, Summary, Feed
-from orders.serializers import FeedSerializer, LineSerializer, LineShortSerializer, \
-    SummarySerializer, BuyerSerializer, PlannerSerializer
+from orders.conditional import conditional_feed
+from orders.models import Line, Buyer, Planner, Summary, Feed, IngestionJob, get_file_checksum
+from orders.serializers import FeedSerializer, LineSerializer, LineShortSerializer, LineRowSerializer, \
+    SummarySerializer, BuyerSerializer, PlannerSerializer, IngestionJobSerializer
+from orders.diff import diff_feeds, get_field_changes
+from orders.exports import EXPORT_CHUNK_SIZE, EXPORT_CONTENT_TYPES, get_export_values, iter_csv_export, \
+    write_xlsx_export
 from orders.filters import LineFilter
+from orders.parsing import check_feed_file
+from orders.jobs import enqueue_feed, requeue_abandoned_job
+from orders.pivot import InvalidPivot, get_pivot
+from orders.trends import InvalidTrend, get_trend
+from orders.rendering import RenderQueueFull, RenderTimeout
 from orders.tasks import generate_summary_context
 
-kit_re = re.compile(r'^EZ(?:C5E|C6|C6A|RD6|FP[RS|PM](?:6A|5E|6))\d{2,3}Q(\d{2,3})-\d{2}$')
+line_row_serializer = LineRowSerializer()
+
+
+def get_rendering_error_response(error):
+    if isinstance(error, RenderQueueFull):
+        return Response({'error': 'Too many reports are being generated, please try again later.'},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(error.retry_after)})
+
+    return Response({'error': 'The report took too long to generate.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
 class FeedView(mixins.ListModelMixin,
@@ -35,12 +51,10 @@ class FeedView(mixins.ListModelMixin,
     queryset = Feed.objects.all()
 
     def get_queryset(self):
-        queryset = self.queryset.prefetch_related(
-            'lines',
-            'lines__buyer',
-            'lines__planner',
-            'uploaded_by',
-        )
+        queryset = self.queryset.select_related('uploaded_by').prefetch_related('buyers', 'planners')
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.filter(ingested=True)
+
         return queryset
 
     def get_serializer_context(self):
@@ -49,6 +63,10 @@ class FeedView(mixins.ListModelMixin,
         
         return context
 
+    @conditional_feed('pk')
+    def retrieve(self, request, *args, **kwargs):
+        return super(FeedView, self).retrieve(request, *args, **kwargs)
+
     @action(methods=['post'], detail=False)
     def upload(self, request, **kwargs):
         if request.FILES.get('file') is None:
@@ -62,95 +80,125 @@ class FeedView(mixins.ListModelMixin,
             request.data['filename'] = request.FILES['file'].name
 
         context = self.get_serializer_context()
+        checksum = getattr(request.FILES['file'], 'checksum', None) or get_file_checksum(request.FILES['file'])
+        existing_job = self.get_duplicate_job(checksum)
+        if existing_job is not None:
+            return self.get_duplicate_response(existing_job, context)
+
+        feed = None
         try:
+            serializer = FeedSerializer(data=request.data, many=False, context=context)
+            serializer.is_valid(raise_exception=True)
+            try:
+                check_feed_file(request.FILES['file'])
+                request.FILES['file'].seek(0)
+
+            except InvalidFileException:
+                return Response('Invalid File!', status=status.HTTP_400_BAD_REQUEST)
+
+            serializer.validated_data['ingested'] = False
+            serializer.validated_data['checksum'] = checksum
+            # built here rather than by the serializer, so its stored file is known if the insert fails
+            feed = Feed(**serializer.validated_data)
             with transaction.atomic():
-                serializer = FeedSerializer(data=request.data, many=False, context=context)
-                serializer.is_valid(raise_exception=True)
-                feed = serializer.create(serializer.validated_data)
-                buyers = {buyer.code: buyer for buyer in Buyer.objects.all()}
-                planners = {planner.code: planner for planner in Planner.objects.all()}
-                try:
-                    wb = load_workbook(feed.file.name, data_only=True)
-
-                except InvalidFileException:
-                    return Response('Invalid File!', status=status.HTTP_400_BAD_REQUEST)
-                
-                summary_dict = {}
-                ws = wb.worksheets[0]
-                for (index, row) in enumerate(ws.rows):
-                    site = row[11].value
-                    confirmed_shipping = row[9].value
-                    if site != '104-CA' or confirmed_shipping is None:
-                        continue
-
-                    quantity = int(float(row[5].value))
-                    buyer_code = row[18].value
-                    planner_code = row[19].value
-                    item_number = row[2].value
-                    if buyer_code == 'ORT':
-                        m = kit_re.match(item_number)
-                        if m is not None:
-                            extended_quantity = quantity * int(m.group(1))
-
-                        else:
-                            extended_quantity = quantity
-
-                    else:
-                        extended_quantity = quantity
-
-                    line = Line.objects.create(
-                        sales_order_number = row[0].value,
-                        item_number = item_number,
-                        revision = row[4].value,
-                        quantity = quantity,
-                        extended_quantity = extended_quantity,
-                        unit = row[6].value,
-                        requested_receipt = row[7].value,
-                        requested_shipping = row[8].value,
-                        confirmed_shipping = confirmed_shipping,
-                        note = row[10].value,
-                        site = site,
-                        ship_to_name = row[12].value,
-                        unit_price = Decimal(row[15].value),
-                        net_amount = Decimal(row[16].value),
-                        customer_reference = row[17].value,
-                        buyer = buyers[buyer_code],
-                        planner = planners[planner_code] if planner_code is not None else planners[buyer_code],
-                        sales_taker = row[20].value,
-                        purchase_order_number = row[21].value,
-                        original_commit_date = row[22].value,
-                        created_at = row[23].value,
-                        updated_at = row[24].value,
-                        feed=feed
-                    )
-                    if line.confirmed_shipping is not None:
-                        start_date = line.confirmed_shipping - timedelta(days=line.confirmed_shipping.weekday())
-                        
-                        try:
-                            summary_dict[start_date][line.buyer]['quantity'] += quantity
-                            summary_dict[start_date][line.buyer]['extended_quantity'] += extended_quantity
-
-                        except KeyError as e:
-                            if str(e).startswith('datetime'):
-                                summary_dict[start_date] = {line.buyer: {'quantity': quantity, 'extended_quantity': extended_quantity}}
-
-                            else:
-                                summary_dict[start_date][line.buyer] = {'quantity': quantity, 'extended_quantity': extended_quantity}
-
-                for (dt, s) in summary_dict.items():
-                    for (b, d) in s.items():
-                        Summary.objects.create(
-                            feed=feed,
-                            start_date=dt,
-                            buyer=b,
-                            quantity=d['quantity'],
-                            extended_quantity=d['extended_quantity'],
-                        )
+                feed.save(force_insert=True)
+                job = enqueue_feed(feed)
+
+        except IntegrityError:
+            # the same file was uploaded concurrently and the other upload won, its copy is the one kept
+            feed.file.delete(save=False)
+            existing_job = self.get_duplicate_job(checksum)
+            if existing_job is None:
+                return Response({'error': 'The file could not be stored, please try again.'}, status=status.HTTP_409_CONFLICT)
+
+            return self.get_duplicate_response(existing_job, context)
+
         except Exception as e:
             return Response({'error': f'The following exception occurred: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
 
-        feed_serializer = FeedSerializer(feed, many=False, context=context)
-        return Response(feed_serializer.data, status=status.HTTP_201_CREATED)
+        job_serializer = IngestionJobSerializer(job, many=False, context=context)
+        return Response(job_serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    @action(methods=['get'], detail=True, url_path=r'diff/(?P<other_pk>[^/.]+)')
+    @conditional_feed('pk')
+    def diff(self, request, pk=None, other_pk=None, **kwargs):
+        feed = get_object_or_404(Feed, pk=pk, ingested=True)
+        other = get_object_or_404(Feed, pk=other_pk, ingested=True)
+        detail = request.query_params.get('detail')
+        if detail not in (None, 'added', 'removed', 'changed'):
+            return Response({'error': 'detail must be one of added, removed or changed.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if detail is not None and self.paginator.is_keyset(request):
+            return Response({'error': 'Cursor pagination is not supported by diffs.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = diff_feeds(feed, other)
+        data = {
+            'feed': feed.id,
+            'other': other.id,
+            'summary': {
+                'added': len(result['added']),
+                'removed': len(result['removed']),
+                'changed': len(result['changed']),
+                'unchanged': result['unchanged'],
+            },
+        }
+        if detail is None:
+            return Response(data, status=status.HTTP_200_OK)
+
+        # only the lines of the requested page are loaded
+        if detail == 'changed':
+            page = self.paginate_queryset(sorted(result['changed'], key=lambda pair: pair[1]))
+            results = list(get_field_changes(page))
+
+        else:
+            page = self.paginate_queryset(sorted(result[detail]))
+            queryset = Line.objects.filter(id__in=page).order_by('id')
+            results = line_row_serializer.serialize(line_row_serializer.get_values(queryset))
+
+        response = self.get_paginated_response(results)
+        response.data = {**data, 'detail': detail, **response.data}
+        return response
+
+    @action(methods=['get'], detail=True, url_path='pivot')
+    @conditional_feed('pk')
+    def pivot(self, request, pk=None, **kwargs):
+        feed = get_object_or_404(Feed, pk=pk, ingested=True)
+        try:
+            pivot = get_pivot(feed, request.query_params)
+
+        except InvalidPivot as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'feed': feed.id, **pivot}, status=status.HTTP_200_OK)
+
+    @action(methods=['get'], detail=False, url_path='trend')
+    def trend(self, request, **kwargs):
+        try:
+            trend = get_trend(request.query_params)
+
+        except InvalidTrend as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(trend, status=status.HTTP_200_OK)
+
+    def get_duplicate_job(self, checksum):
+        return IngestionJob.objects.filter(feed__checksum=checksum).first()
+
+    def get_duplicate_response(self, job, context):
+        # a job whose worker died or that was never picked up is handed to the pool again, like a new upload
+        requeued = requeue_abandoned_job(job)
+        if requeued:
+            job.refresh_from_db()
+
+        job_serializer = IngestionJobSerializer(job, many=False, context=context)
+        return Response(job_serializer.data, status=status.HTTP_202_ACCEPTED if requeued else status.HTTP_200_OK)
+
+    @action(methods=['get'], detail=True, url_path='status')
+    def ingestion_status(self, request, pk=None, **kwargs):
+        job = get_object_or_404(IngestionJob, feed__id=pk)
+        job_serializer = IngestionJobSerializer(job, many=False, context=self.get_serializer_context())
+        return Response(job_serializer.data, status=status.HTTP_200_OK)
 
 
 class OrderView(mixins.ListModelMixin,
@@ -181,6 +229,23 @@ class OrderView(mixins.ListModelMixin,
 
         return queryset
 
+    @conditional_feed('feed_pk')
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = line_row_serializer.get_values(queryset)
+        if self.paginator is not None and self.paginator.is_unpaginated(request):
+            return self.paginator.get_streaming_response(rows, line_row_serializer.serialize)
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(line_row_serializer.serialize(page))
+
+        return Response(line_row_serializer.serialize(rows))
+
+    @conditional_feed('feed_pk')
+    def retrieve(self, request, *args, **kwargs):
+        return super(OrderView, self).retrieve(request, *args, **kwargs)
+
     def get_serializer_class(self):
         if self.action == 'list':
             return LineShortSerializer
@@ -191,10 +256,39 @@ class OrderView(mixins.ListModelMixin,
         return self.serializer_class
 
     @action(detail=False, methods=('get',), url_path='export')
+    @conditional_feed('feed_pk')
     def export(self, request, **kwargs):
         context = self.get_serializer_context()
-        orders_export = context['feed'].get_orders_export(query_params=request.query_params)
-        return Response({'report': orders_export}, status.HTTP_200_OK)
+        try:
+            orders_export = context['feed'].get_orders_export(query_params=request.query_params)
+
+        except (RenderQueueFull, RenderTimeout) as e:
+            return get_rendering_error_response(e)
+
+        if request.query_params.get('encoding') == 'base64':
+            with orders_export:
+                return Response({'report': b64encode(orders_export.read()).decode('ascii')}, status.HTTP_200_OK)
+
+        filename = f'{os.path.splitext(context["feed"].filename)[0]}.pdf'
+        return FileResponse(orders_export, filename=filename, content_type='application/pdf')
+
+    @action(detail=False, methods=('get',), url_path=r'export\.(?P<export_format>csv|xlsx)')
+    @conditional_feed('feed_pk')
+    def export_rows(self, request, export_format=None, **kwargs):
+        context = self.get_serializer_context()
+        queryset = get_export_values(self.filter_queryset(self.get_queryset()))
+        chunks = self.paginator.iter_keyset_chunks(queryset, EXPORT_CHUNK_SIZE)
+        name = os.path.splitext(context['feed'].filename)[0] if 'feed' in context else 'orders'
+        filename = f'{name}.{export_format}'
+        if export_format == 'csv':
+            response = StreamingHttpResponse(iter_csv_export(chunks), content_type=EXPORT_CONTENT_TYPES['csv'])
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
+
+        dst = TemporaryFile()
+        write_xlsx_export(chunks, dst)
+        dst.seek(0)
+        return FileResponse(dst, as_attachment=True, filename=filename, content_type=EXPORT_CONTENT_TYPES['xlsx'])
 
 
 class SummaryView(mixins.ListModelMixin,
@@ -222,11 +316,30 @@ class SummaryView(mixins.ListModelMixin,
 
         return queryset.order_by('start_date', 'buyer__code')
 
+    @conditional_feed('feed_pk')
+    def list(self, request, *args, **kwargs):
+        return super(SummaryView, self).list(request, *args, **kwargs)
+
+    @conditional_feed('feed_pk')
+    def retrieve(self, request, *args, **kwargs):
+        return super(SummaryView, self).retrieve(request, *args, **kwargs)
+
     @action(detail=False, methods=('get',), url_path='export')
+    @conditional_feed('feed_pk')
     def export(self, request, **kwargs):
         context = self.get_serializer_context()
-        summary_export = context['feed'].get_summary_export()
-        return Response({'report': summary_export,}, status.HTTP_200_OK)
+        try:
+            summary_export = context['feed'].get_summary_export()
+
+        except (RenderQueueFull, RenderTimeout) as e:
+            return get_rendering_error_response(e)
+
+        if request.query_params.get('encoding') == 'base64':
+            with summary_export:
+                return Response({'report': b64encode(summary_export.read()).decode('ascii')}, status.HTTP_200_OK)
+
+        filename = f'{os.path.splitext(context["feed"].filename)[0]}-summary.pdf'
+        return FileResponse(summary_export, filename=filename, content_type='application/pdf')
 
 
 class BuyerView(mixins.ListModelMixin,
@@ -85,8 +85,12 @@ class UserSerializer(serializers.ModelSerializer):
 
     def get_pending_requests(self, instance):
         if instance.is_admin:
-            requests = User.objects.filter(is_active=False, is_admin=False)
-            serializer = UserSerializer(requests[:5], many=True, context=self.context)
-            return serializer.data
+            # the same for every admin, computed once when many users are serialized with the same context
+            if 'pending_requests' not in self.context:
+                requests = User.objects.filter(is_active=False, is_admin=False)
+                serializer = UserSerializer(requests[:5], many=True, context=self.context)
+                self.context['pending_requests'] = serializer.data
+
+            return self.context['pending_requests']
 
         return None